@@ -0,0 +1,61 @@
+# Сату жылдамдығы мен қалдықтың таусылу болжамы (NumPy).
+# Күндік OUT сандары [тауар id, күн % window] сақинасында жиналады: жаңа
+# қозғалыстар np.add.at арқылы қосылады, терезеден шыққан күндер нөлденеді —
+# бүкіл каталогтың болжамы бір векторлық есептеу.
+import numpy as np
+
+class SalesVelocity:
+    def __init__(self, window=28):
+        self.window = window
+        self.bins = np.zeros((0, window), dtype=np.int32)
+        self.today = None   # соңғы ескерілген күн (ordinal)
+
+    def _grow(self, max_pid):
+        if max_pid < len(self.bins):
+            return
+        size = max(max_pid + 1, len(self.bins) * 2, 1024)
+        bins = np.zeros((size, self.window), dtype=np.int32)
+        bins[:len(self.bins)] = self.bins
+        self.bins = bins
+
+    # Сақинаны today-ге дейін жылжытамыз: арадағы күндердің ескі мәндері өшеді
+    def advance(self, today):
+        if self.today is None or today - self.today >= self.window:
+            self.bins[:] = 0
+        elif today > self.today:
+            cols = np.arange(self.today + 1, today + 1) % self.window
+            self.bins[:, cols] = 0
+        self.today = today if self.today is None else max(self.today, today)
+
+    # rows: (product_id, day_ordinal, qty) массиві
+    def add(self, rows):
+        if not len(rows):
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        pids, days, qtys = rows[:, 0], rows[:, 1], rows[:, 2]
+        keep = (days <= self.today) & (days > self.today - self.window)
+        pids, days, qtys = pids[keep], days[keep], qtys[keep]
+        if not len(pids):
+            return
+        self._grow(int(pids.max()))
+        np.add.at(self.bins, (pids, days % self.window), qtys)
+
+    # pids / qtys — ағымдағы каталог. Қайтарады: velocity (дана/күн),
+    # days_left (inf — сатылмайды), reorder (ұсынылатын тапсырыс саны).
+    # reorder = lead + cover күнге жететін сұраныс + safety stock − қалдық,
+    # safety = z · σ(күндік сату) · √lead.
+    def forecast(self, pids, qtys, lead_days=7, cover_days=14, z=1.65):
+        pids = np.asarray(pids, dtype=np.int64)
+        qtys = np.asarray(qtys, dtype=np.float64)
+        daily = np.zeros((len(pids), self.window), dtype=np.float64)
+        known = pids < len(self.bins)
+        daily[known] = self.bins[pids[known]]
+
+        velocity = daily.mean(axis=1)
+        sigma = daily.std(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            days_left = np.where(velocity > 0, qtys / velocity, np.inf)
+        need = velocity * (lead_days + cover_days) + z * sigma * np.sqrt(lead_days)
+        reorder = np.maximum(np.ceil(need - qtys), 0).astype(np.int64)
+        reorder[velocity == 0] = 0
+        return velocity, days_left, reorder
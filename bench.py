@@ -0,0 +1,365 @@
+# Желісіз жүктеме бенчмаркі: Telegram HTTP қабаты жергілікті жазғышпен
+# ауыстырылады, синтетикалық Update ағындары bot.process_new_updates арқылы
+# өтеді. Нәтиже: ағын (flow) бойынша өткізу қабілеті, p50/p99 және DB уақыты.
+#
+#   python bench.py --products 100000 --movements 10000000 --users 16 --flows 200
+#   python bench.py --tenants 4 --users 16 --scenarios sale,import
+#   python bench.py --json after.json --baseline before.json
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# main импортталмай тұрып: токен, жол және outbox шектері (бенчмарк Telegram
+# лимитін емес, боттың өзін өлшейді)
+os.environ.setdefault("BOT_TOKEN", "0:BENCH")
+os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000")
+os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000")
+os.environ.pop("WEBHOOK_URL", None)
+
+WORDS = ("Қант", "Ұн", "Нан", "Сүт", "Айран", "Құрт", "Шай", "Күріш", "Май", "Ет",
+         "Тұз", "Жұмыртқа", "Қымыз", "Бал", "Сабын", "Кофе", "Печенье", "Сірке", "Өрік", "Үлпек")
+KINDS = ("ақ", "қара", "үлкен", "кіші", "жаңа", "Алматы", "Шымкент", "премиум")
+QUERIES = ("кант", "сут", "айран", "курт", "кофе", "бал", "Нан", "премиум", "Алматы", "орик")
+FLOW_MIX = {"sale": 50, "search": 25, "journal": 20, "import": 5}
+BENCH_UID = 700000000
+
+# --------- TELEGRAM ОРНЫНА ----------
+class FakeTelegram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.files = {}
+        self._mid = itertools.count(1)
+
+    def sender(self, method, url, params=None, files=None, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        params = params or {}
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if files:
+            for f in files.values():
+                f = f[1] if isinstance(f, tuple) else f
+                if hasattr(f, "read"):
+                    f.read()
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name in ("sendMessage", "sendDocument", "editMessageText"):
+            result = {"message_id": next(self._mid), "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+        elif name == "getFile":
+            fid = params.get("file_id")
+            result = {"file_id": fid, "file_unique_id": fid, "file_path": fid}
+        else:
+            result = True
+        return FakeResponse({"ok": True, "result": result})
+
+    def download(self, token, file_path):
+        with self.lock:
+            return self.files.pop(file_path)
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+# --------- ДЕРЕКТЕР ----------
+def seed(main, path, products, movements, rng):
+    with main.tenant_scope(main.Tenant(0, "seed", "seed", path)):
+        con = main.db()
+        seed_rows(con, products, movements, rng)
+    main._db_local.cons.pop(path).close()
+
+def seed_rows(con, products, movements, rng):
+    t0 = time.perf_counter()
+    today = datetime.now().date()
+    rows = []
+    for i in range(products):
+        exp = (today + timedelta(days=rng.randint(-30, 400))).toordinal() if rng.random() < 0.6 else None
+        minq = rng.choice((0, 0, 0, 5, 10))
+        rows.append((f"{rng.choice(WORDS)} {rng.choice(KINDS)} {i}", rng.randint(500, 5000), exp, minq))
+        if len(rows) == 10000:
+            with con:
+                con.executemany("INSERT INTO products(name, qty, exp_day, min_qty) VALUES(?,?,?,?)", rows)
+            rows = []
+    with con:
+        con.executemany("INSERT INTO products(name, qty, exp_day, min_qty) VALUES(?,?,?,?)", rows)
+
+    # created_at id-мен бірге өседі (журнал күн шекарасын осыған сүйенеді)
+    start = time.time() - 365 * 86400
+    step = 365 * 86400 / max(movements, 1)
+    mtypes = ("IN", "OUT", "OUT", "OUT", "WRITE_OFF")
+    rows = []
+    for i in range(movements):
+        ts = int(start + step * i)
+        rows.append((rng.randint(1, products), rng.choice(mtypes), rng.randint(1, 20), ts, ""))
+        if len(rows) == 50000:
+            with con:
+                con.executemany(
+                    "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)", rows
+                )
+            rows = []
+            print(f"\rseeding movements {i + 1}/{movements}", end="", file=sys.stderr)
+    with con:
+        con.executemany(
+            "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)", rows
+        )
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"\rseeded {products} products, {movements} movements in {time.perf_counter() - t0:.1f}s",
+          file=sys.stderr)
+
+# --------- СИНТЕТИКАЛЫҚ UPDATE ----------
+_update_ids = itertools.count(1)
+
+def message_update(types, uid, text=None, **extra):
+    msg = {"message_id": next(_update_ids), "date": 0,
+           "chat": {"id": uid, "type": "private"},
+           "from": {"id": uid, "is_bot": False, "first_name": "bench"}, **extra}
+    if text is not None:
+        msg["text"] = text
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update.de_json({"update_id": next(_update_ids), "message": msg})
+
+def import_csv(rng, max_pid, rows):
+    out = ["id,name,qty,exp_date,min_qty"]
+    for i in range(rows):
+        if rng.random() < 0.5:
+            out.append(f"{rng.randint(1, max_pid)},,{rng.randint(1, 50)},,")
+        else:
+            out.append(f",{rng.choice(WORDS)} импорт {rng.random():.6f},{rng.randint(1, 100)},,0")
+    return "\n".join(out).encode("utf-8")
+
+# Әр ағын — бір пайдаланушының қатар жіберетін хабарламалары
+def flow_steps(name, types, fake, uid, rng, max_pid, import_rows):
+    if name == "sale":
+        pid = rng.randint(1, max_pid)
+        return [message_update(types, uid, "➖ Сату тіркеу"),
+                message_update(types, uid, str(pid)),
+                message_update(types, uid, "1")]
+    if name == "search":
+        return [message_update(types, uid, "🔎 Іздеу"),
+                message_update(types, uid, rng.choice(QUERIES))]
+    if name == "journal":
+        arg = rng.choice(("", " OUT", f" {rng.randint(1, max_pid)}",
+                          f" {(datetime.now() - timedelta(days=rng.randint(1, 300))).date()}"))
+        return [message_update(types, uid, "/journal" + arg)]
+    if name == "import":
+        file_id = f"bench/{next(_update_ids)}.csv"
+        with fake.lock:
+            fake.files[file_id] = import_csv(rng, max_pid, import_rows)
+        doc = {"file_id": file_id, "file_unique_id": file_id, "file_name": "bench.csv"}
+        return [message_update(types, uid, document=doc)]
+    raise ValueError(name)
+
+# --------- ӨЛШЕУ ----------
+class Pending:
+    __slots__ = ("event", "db")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.db = 0.0
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="qoyma_bench_")
+    # нақты DB_PATH-қа ешқашан жазбаймыз (state.db қойма файлының қасында)
+    os.environ["DB_PATH"] = os.path.join(work_dir, "warehouse.db")
+    os.environ["REGISTRY_PATH"] = os.path.join(work_dir, "registry.db")
+    os.environ["TENANTS_DIR"] = os.path.join(work_dir, "tenants")
+
+    import telebot
+    from telebot import apihelper, types
+    fake = FakeTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = fake.sender
+    apihelper.download_file = fake.download
+
+    import main
+    rng = random.Random(args.seed)
+
+    template = args.db or os.path.join(
+        tempfile.gettempdir(), f"qoyma_bench_{args.products}_{args.movements}_{args.seed}.db"
+    )
+    if not os.path.exists(template):
+        seed(main, template + ".tmp", args.products, args.movements, rng)
+        os.replace(template + ".tmp", template)
+    # бенчмарк деректерді өзгертеді — әр қойма үлгінің көшірмесінде жұмыс істейді
+    shops = [main.tenants.default()]
+    shops += [main.tenants.add(f"bench{i}", f"Bench {i}") for i in range(1, args.tenants)]
+    for shop in shops:
+        shutil.copyfile(template, shop.db_path)
+    with main.tenant_scope(shops[0]):
+        max_pid = main.db().execute("SELECT MAX(id) FROM products").fetchone()[0] or 1
+
+    # қолданушылар қоймаларға кезекпен бөлінеді
+    uids = [BENCH_UID + i for i in range(args.users)]
+    for i, uid in enumerate(uids):
+        main.tenants.add_user(uid, shops[i % len(shops)])
+
+    # Update аяқталғанын және оның DB уақытын worker потогында ұстаймыз
+    pending = {}
+    local = threading.local()
+    db_observe = main.DB_TIMING.observe
+
+    def observe_db(key, seconds, error=False):
+        local.db = getattr(local, "db", 0.0) + seconds
+        db_observe(key, seconds, error)
+    main.DB_TIMING.observe = observe_db
+
+    base_process = telebot.TeleBot.process_new_updates
+
+    def process_and_signal(self, updates):
+        local.db = 0.0
+        try:
+            base_process(self, updates)
+        finally:
+            for update in updates:
+                rec = pending.pop(update.update_id)
+                rec.db = local.db
+                rec.event.set()
+    telebot.TeleBot.process_new_updates = process_and_signal
+
+    mix = [name for name, weight in FLOW_MIX.items() if name in args.scenarios for _ in range(weight)]
+    results = {name: {"latency": [], "db": [], "updates": 0} for name in args.scenarios}
+    results_lock = threading.Lock()
+    db_before = main.DB_TIMING.snapshot()
+
+    def client(uid, flows, client_rng):
+        for _ in range(flows):
+            name = client_rng.choice(mix)
+            steps = flow_steps(name, types, fake, uid, client_rng, max_pid, args.import_rows)
+            t0 = time.perf_counter()
+            db_time = 0.0
+            for update in steps:
+                rec = pending[update.update_id] = Pending()
+                main.bot.process_new_updates([update])
+                rec.event.wait()
+                db_time += rec.db
+            elapsed = time.perf_counter() - t0
+            with results_lock:
+                results[name]["latency"].append(elapsed)
+                results[name]["db"].append(db_time)
+                results[name]["updates"] += len(steps)
+
+    threads = [
+        threading.Thread(target=client, args=(uid, args.flows, random.Random(args.seed * 1000 + i)))
+        for i, uid in enumerate(uids)
+    ]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    main.outbox.wait_idle(60)
+
+    db_after = main.DB_TIMING.snapshot()
+    statements = []
+    for key, (count, total, _) in db_after.items():
+        count0, total0, _ = db_before.get(key, (0, 0.0, 0))
+        if count > count0:
+            statements.append((total - total0, count - count0, key))
+    statements.sort(reverse=True)
+
+    report = {
+        "params": {k: getattr(args, k) for k in ("products", "movements", "tenants", "users", "flows", "import_rows", "seed")},
+        "wall_s": wall,
+        "updates": sum(data["updates"] for data in results.values()),
+        "flows": {},
+        "telegram_calls": dict(fake.calls),
+        "top_statements": [{"sql": sql, "count": n, "total_ms": total * 1000} for total, n, sql in statements[:10]],
+    }
+    for name, data in results.items():
+        lat, dbt = data["latency"], data["db"]
+        if not lat:
+            continue
+        report["flows"][name] = {
+            "count": len(lat),
+            "per_s": len(lat) / wall,
+            "p50_ms": percentile(lat, 0.50) * 1000,
+            "p99_ms": percentile(lat, 0.99) * 1000,
+            "db_ms": sum(dbt) / len(dbt) * 1000,
+        }
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+def format_report(report, baseline=None):
+    p = report["params"]
+    total = sum(f["count"] for f in report["flows"].values())
+    lines = [
+        f"products={p['products']} movements={p['movements']} tenants={p.get('tenants', 1)} users={p['users']} "
+        f"flows/user={p['flows']} import_rows={p['import_rows']} seed={p['seed']}",
+        f"wall {report['wall_s']:.2f}s, {total / report['wall_s']:.1f} flows/s, "
+        f"{report['updates'] / report['wall_s']:.1f} updates/s",
+        "",
+        f"{'flow':<10}{'count':>8}{'flows/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'db ms':>10}",
+    ]
+    for name, f in report["flows"].items():
+        line = f"{name:<10}{f['count']:>8}{f['per_s']:>10.1f}{f['p50_ms']:>10.2f}{f['p99_ms']:>10.2f}{f['db_ms']:>10.2f}"
+        base = (baseline or {}).get("flows", {}).get(name)
+        if base:
+            line += (f"   vs baseline: p50 {delta(f['p50_ms'], base['p50_ms'])}, "
+                     f"p99 {delta(f['p99_ms'], base['p99_ms'])}, flows/s {delta(f['per_s'], base['per_s'])}")
+        lines.append(line)
+    lines += ["", "top statements by DB time:"]
+    for st in report["top_statements"]:
+        lines.append(f"{st['total_ms']:>10.1f} ms {st['count']:>8}x  {st['sql']}")
+    lines += ["", "telegram calls: " + ", ".join(f"{k}={v}" for k, v in sorted(report["telegram_calls"].items()))]
+    return "\n".join(lines)
+
+def delta(now, before):
+    return f"{(now - before) / before * 100:+.1f}%" if before else "n/a"
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="Offline load benchmark for the warehouse bot")
+    ap.add_argument("--products", type=int, default=100000)
+    ap.add_argument("--movements", type=int, default=1000000)
+    ap.add_argument("--tenants", type=int, default=1, help="warehouses (one database each), users spread evenly")
+    ap.add_argument("--users", type=int, default=8, help="concurrent simulated users")
+    ap.add_argument("--flows", type=int, default=100, help="flows per user")
+    ap.add_argument("--import-rows", type=int, default=500)
+    ap.add_argument("--scenarios", default=",".join(FLOW_MIX), help="comma separated: " + ",".join(FLOW_MIX))
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", help="seeded template database (created if missing)")
+    ap.add_argument("--out", default="bench_output.txt")
+    ap.add_argument("--json", help="write raw results as JSON")
+    ap.add_argument("--baseline", help="JSON from an earlier run to compare against")
+    args = ap.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(FLOW_MIX)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report = run(args)
+    text = format_report(report, baseline)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
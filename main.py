@@ -6,60 +6,1524 @@ import os
 import telebot
 from telebot import types
 import sqlite3
-from datetime import datetime, date
+import time
+import hashlib
+import hmac
+import json
+import heapq
+import requests
+import re
+import io
+import csv
+import gzip
+import tempfile
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
+from functools import wraps
+from datetime import datetime, date, timedelta
+from bisect import bisect_left, bisect_right, insort
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise RuntimeError("BOT_TOKEN environment variable not set")
 
-bot = telebot.TeleBot(TOKEN)
+# Webhook режимі: WEBHOOK_URL берілсе (мыс. https://qoyma.example.com) жаңартулар
+# Flask /webhook/<secret> арқылы келеді, бос болса — бұрынғыдай long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "256"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+
+# --------- UPDATE EXECUTOR ----------
+# Бір пайдаланушының жаңартулары қатаң ретпен (жеке кезек), әртүрлі
+# пайдаланушылар ортақ pool-да параллель орындалады. Кезек процесс ішінде ғана:
+# рет тек бір gunicorn worker-де сақталады (Procfile: --workers 1 --threads).
+class UserExecutor:
+    BATCH = 16  # бір пайдаланушы worker-ді ұзақ ұстамауы үшін
+
+    def __init__(self, workers=UPDATE_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="updates")
+        self._cond = threading.Condition()
+        self._queues = {}   # key -> deque; кілт бар кезде оны бір ғана worker өңдеп жатыр
+        self.pending = 0
+
+    def submit(self, key, fn, *args):
+        with self._cond:
+            self.pending += 1
+            q = self._queues.get(key)
+            if q is not None:
+                q.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._pool.submit(self._drain, key)
+
+    def _drain(self, key):
+        for _ in range(self.BATCH):
+            with self._cond:
+                q = self._queues[key]
+                if not q:
+                    del self._queues[key]
+                    return
+                fn, args = q.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"update task for {key} failed: {e}")
+            finally:
+                with self._cond:
+                    self.pending -= 1
+                    if not self.pending:
+                        self._cond.notify_all()
+        # кезек әлі бос емес — келесі айналымға орын береміз
+        self._pool.submit(self._drain, key)
+
+    def wait_idle(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pending, timeout)
+
+update_executor = UserExecutor()
+
+def update_user_id(update):
+    for obj in (update.message, update.edited_message, update.callback_query,
+                update.inline_query, update.my_chat_member):
+        user = getattr(obj, "from_user", None)
+        if user is not None:
+            return user.id
+    return 0
+
+# --------- OUTBOX (шығыс хабарламалар кезегі) ----------
+# send_message / send_document handler потогын бөгемейді: чатқа жеке кезекке
+# түсіп, фондық worker-лер Telegram шектеріне сай (token bucket: чат сайын және
+# жалпы) жібереді. 429 болса retry_after күтеді, желі/5xx қателерін қайталайды,
+# бір чатқа қатар тұрған қысқа мәтіндерді бір хабарламаға біріктіреді.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))   # хабарлама/сек
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = 5
+OUTBOX_MAX_TRIES = 5
+OUTBOX_MERGE_LIMIT = 4000
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Outbox:
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self._cond = threading.Condition()
+        self._queues = {}     # chat_id -> deque; кілт бар = чат белсенді (ready/delayed/жіберуде)
+        self._ready = deque()
+        self._delayed = []    # heap: (monotonic уақыт, chat_id)
+        self._buckets = {}
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self.pending = 0
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True).start()
+
+    def put(self, chat_id, fn, args, kwargs, text=None):
+        item = {"fn": fn, "args": args, "kwargs": kwargs, "text": text, "tries": 0}
+        with self._cond:
+            self.pending += 1
+            q = self._queues.get(chat_id)
+            if q is not None:
+                q.append(item)
+                return
+            self._queues[chat_id] = deque([item])
+            self._ready.append(chat_id)
+            self._cond.notify()
+
+    def wait_idle(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pending, timeout)
+
+    def _next_chat(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.append(heapq.heappop(self._delayed)[1])
+            if self._ready:
+                chat_id = self._ready.popleft()
+                bucket = self._buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self._buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+                wait = max(bucket.wait_time(now), self._global.wait_time(now))
+                if wait > 0:
+                    heapq.heappush(self._delayed, (now + wait, chat_id))
+                    continue
+                bucket.take()
+                self._global.take()
+                return chat_id, self._take_items(chat_id)
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            self._cond.wait(timeout)
+
+    # Қатар тұрған мәтіндерді біріктіреміз: клавиатура тек соңғысында болуы мүмкін.
+    # Inline клавиатуралы хабарлама кейін edit_message_text-пен ауысады (lst:/jr:
+    # беттеу) — оған басқа мәтін қосылса, ол да өшіп кетеді.
+    def _take_items(self, chat_id):
+        q = self._queues[chat_id]
+        items = [q.popleft()]
+        while q and items[-1]["text"] is not None and q[0]["text"] is not None:
+            last, nxt = items[-1], q[0]
+            if set(last["kwargs"]) or set(nxt["kwargs"]) - {"reply_markup"}:
+                break
+            markup = nxt["kwargs"].get("reply_markup")
+            if markup is not None and not isinstance(markup, types.ReplyKeyboardMarkup):
+                break
+            if sum(len(i["text"]) + 1 for i in items) + len(nxt["text"]) > OUTBOX_MERGE_LIMIT:
+                break
+            items.append(q.popleft())
+        return items
+
+    def _send(self, items):
+        item = items[0]
+        if len(items) == 1:
+            return item["fn"](*item["args"], **item["kwargs"])
+        text = "\n".join(i["text"] for i in items)
+        return item["fn"](item["args"][0], text, **items[-1]["kwargs"])
+
+    def _run(self):
+        while True:
+            with self._cond:
+                chat_id, items = self._next_chat()
+            delay = None
+            try:
+                for i in items:
+                    doc = i["kwargs"].get("document")
+                    if hasattr(doc, "seek"):
+                        doc.seek(0)
+                self._send(items)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    delay = float((e.result_json.get("parameters") or {}).get("retry_after", 1))
+                elif e.error_code >= 500:
+                    delay = 2 ** items[0]["tries"]
+                else:
+                    print(f"outbox: drop message to {chat_id}: {e}")
+            except (telebot.apihelper.ApiHTTPException, requests.exceptions.RequestException) as e:
+                delay = 2 ** items[0]["tries"]
+                print(f"outbox: retry message to {chat_id}: {e}")
+            except Exception as e:
+                print(f"outbox: drop message to {chat_id}: {e}")
+
+            if delay is not None:
+                items[0]["tries"] += 1
+                if items[0]["tries"] >= OUTBOX_MAX_TRIES:
+                    print(f"outbox: giving up on message to {chat_id}")
+                    delay = None
+            with self._cond:
+                q = self._queues[chat_id]
+                if delay is not None:
+                    # біріктірілгендерді қайта кезектің басына — ретін сақтап
+                    q.extendleft(reversed(items))
+                    heapq.heappush(self._delayed, (time.monotonic() + delay, chat_id))
+                    self._cond.notify()
+                    continue
+                self.pending -= len(items)
+                for i in items:
+                    doc = i["kwargs"].get("document")
+                    if hasattr(doc, "close"):
+                        doc.close()
+                if q:
+                    self._ready.append(chat_id)
+                    self._cond.notify()
+                else:
+                    del self._queues[chat_id]
+                    if len(self._buckets) > 10000:
+                        self._buckets.clear()
+                if not self.pending:
+                    self._cond.notify_all()
+
+outbox = Outbox()
+
+class WarehouseBot(telebot.TeleBot):
+    def process_new_updates(self, updates):
+        for update in updates:
+            # polling offset-і дереу жылжиды, өңдеу update_executor-да
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            update_executor.submit(update_user_id(update), self._process_update, update)
+
+    # қолданушының қоймасын қойып өңдейміз; ешбір қоймаға кірмесе — рұқсат жоқ
+    def _process_update(self, update):
+        tenant = tenants.for_user(update_user_id(update))
+        if tenant is None:
+            if update.message is not None:
+                self.send_message(update.message.chat.id, ACCESS_DENIED_TEXT)
+            return
+        with tenant_scope(tenant):
+            super().process_new_updates([update])
+
+    # handler-лер жіберуді күтпейді — outbox кезегіне қояды
+    def send_message(self, chat_id, text, **kwargs):
+        outbox.put(chat_id, super().send_message, (chat_id, text), kwargs, text=text)
+
+    def send_document(self, chat_id, document, **kwargs):
+        kwargs["document"] = document
+        outbox.put(chat_id, super().send_document, (chat_id,), kwargs)
+
+    # тіркелген әр handler уақыты мен қатесі метрикаға жазылады
+    def add_message_handler(self, handler_dict):
+        handler_dict["function"] = instrumented(handler_dict["function"])
+        super().add_message_handler(handler_dict)
+
+    def add_callback_query_handler(self, handler_dict):
+        handler_dict["function"] = instrumented(handler_dict["function"])
+        super().add_callback_query_handler(handler_dict)
 
-DB_PATH = "warehouse.db"
+# handler-лер update_executor worker-інде орындалады, telebot-тың ішкі pool-ы керек емес
+bot = WarehouseBot(TOKEN, threaded=False)
+
+DB_PATH = os.getenv("DB_PATH", "warehouse.db")
+
+EXP_HORIZON_DAYS = int(os.getenv("EXP_HORIZON_DAYS", "30"))
 
 ADMIN_IDS = {975183266}
-ALLOWED_USERS = {975183266}
+ALLOWED_USERS = {975183266}   # негізгі қойманың алғашқы қолданушылары (registry бос болғанда)
+ACCESS_DENIED_TEXT = (
+    "⛔ Бұл ботқа қол жеткізу шектеулі.\n"
+    "Қойма есебі тек уәкілетті пайдаланушыларға арналған."
+)
+
+# --------- МЕТРИКА (Prometheus мәтін форматы, /metrics) ----------
+# Handler-лер мен SQL сұраулары уақыт гистограммасына жазылады (санау және
+# қате саны қоса). Бір жазу — bisect + құлып астында бірнеше қосу, сондықтан
+# үнемі қосулы тұра береді. Мәндер процесс ішінде: gunicorn worker-лері бөлек.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def metric_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Timing:
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}   # label мәні -> [bucket-тер (+Inf соңында), қосынды, қате саны]
+
+    def observe(self, key, seconds, error=False):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += seconds
+            if error:
+                series[2] += 1
+
+    # {label мәні: (саны, қосынды секунд, қате саны)}
+    def snapshot(self):
+        with self._lock:
+            return {k: (sum(v[0]), v[1], v[2]) for k, v in self._series.items()}
+
+    def render(self, out):
+        with self._lock:
+            items = sorted((k, list(v[0]), v[1], v[2]) for k, v in self._series.items())
+        out.append(f"# HELP {self.name}_seconds {self.help}")
+        out.append(f"# TYPE {self.name}_seconds histogram")
+        for key, counts, total, _ in items:
+            lab = f'{self.label}="{metric_label(key)}"'
+            acc = 0
+            for bound, n in zip(self.buckets, counts):
+                acc += n
+                out.append(f'{self.name}_seconds_bucket{{{lab},le="{bound}"}} {acc}')
+            acc += counts[-1]
+            out.append(f'{self.name}_seconds_bucket{{{lab},le="+Inf"}} {acc}')
+            out.append(f"{self.name}_seconds_sum{{{lab}}} {total:.6f}")
+            out.append(f"{self.name}_seconds_count{{{lab}}} {acc}")
+        out.append(f"# HELP {self.name}_errors_total {self.help} (қатемен аяқталғаны)")
+        out.append(f"# TYPE {self.name}_errors_total counter")
+        for key, _, _, errors in items:
+            out.append(f'{self.name}_errors_total{{{self.label}="{metric_label(key)}"}} {errors}')
+
+HANDLER_TIMING = Timing("bot_handler", "Handler орындалу уақыты", "handler")
+DB_TIMING = Timing("bot_db", "SQL сұрауының орындалу уақыты", "statement")
+
+def timed_handler(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    error = True
+    try:
+        fn(*args, **kwargs)
+        error = False
+    finally:
+        HANDLER_TIMING.observe(fn.__name__, time.perf_counter() - t0, error)
+
+# Router ішкі handler-ді өзі өлшейді (self_timed) — екі рет санамаймыз
+def self_timed(fn):
+    fn.self_timed = True
+    return fn
+
+def instrumented(fn):
+    if getattr(fn, "self_timed", False):
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        timed_handler(fn, *args, **kwargs)
+    return wrapper
+
+# Сұрау мәтінін белгіге айналдырамыз: бос орын бір пробел, IN (?,?,...) -> IN (?…),
+# әйтпесе әр ұзындықтағы IN бөлек серия болар еді. Нәтиже кэштеледі.
+SQL_LABEL_MAX = 160
+_SQL_PLACEHOLDERS = re.compile(r"\?(?:\s*,\s*\?)+")
+_SQL_SPACES = re.compile(r"\s+")
+_SQL_COMMENTS = re.compile(r"--[^\n]*")
+_sql_labels = {}
+
+def sql_label(sql):
+    label = _sql_labels.get(sql)
+    if label is None:
+        label = _SQL_COMMENTS.sub("", sql)
+        label = _SQL_PLACEHOLDERS.sub("?…", _SQL_SPACES.sub(" ", label).strip())[:SQL_LABEL_MAX]
+        if len(_sql_labels) < 2000:
+            _sql_labels[sql] = label
+    return label
+
+def timed_sql(fn, obj, sql, args):
+    t0 = time.perf_counter()
+    error = True
+    try:
+        result = fn(obj, sql, *args)
+        error = False
+        return result
+    finally:
+        DB_TIMING.observe(sql_label(sql), time.perf_counter() - t0, error)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        return timed_sql(sqlite3.Cursor.execute, self, sql, args)
+
+    def executemany(self, sql, *args):
+        return timed_sql(sqlite3.Cursor.executemany, self, sql, args)
+
+# Connection.execute курсорды C ішінде ашады, сондықтан оны да бөлек орағанбыз
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return timed_sql(sqlite3.Connection.execute, self, sql, args)
+
+    def executemany(self, sql, *args):
+        return timed_sql(sqlite3.Connection.executemany, self, sql, args)
+
+def render_metrics():
+    out = []
+    HANDLER_TIMING.render(out)
+    DB_TIMING.render(out)
+    gauges = (
+        ("bot_update_queue_depth", "Өңделуін күтіп тұрған жаңартулар", update_executor.pending),
+        ("bot_outbox_queue_depth", "Жіберілуін күтіп тұрған хабарламалар", outbox.pending),
+        ("bot_state_entries", "Жадтағы қадам (state) жазбалары", sum(len(s) for s in state_store.all())),
+        ("bot_product_cache_entries", "Тауар кэшіндегі жазбалар", sum(len(c) for c in product_cache.all())),
+        ("bot_tenants", "Қоймалар саны", len(tenants.all())),
+    )
+    for name, help_text, value in gauges:
+        out += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    counters = (
+        ("bot_product_cache_hits_total", "Тауар кэшінен табылған сұраулар", sum(c.hits for c in product_cache.all())),
+        ("bot_product_cache_misses_total", "Тауар кэшінен табылмаған сұраулар", sum(c.misses for c in product_cache.all())),
+        ("bot_updates_total", "Router арқылы өткен жаңартулар", ROUTER_STATS["updates"]),
+    )
+    for name, help_text, value in counters:
+        out += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+    return "\n".join(out) + "\n"
+
+# --------- ҚОЙМАЛАР (tenant) ----------
+# Әр қойманың өз SQLite файлы бар — бір дүкеннің жазуы басқасының жазу құлпын
+# күтпейді. Қолданушы -> қойма байланысы registry.db-да. Ағымдағы қойма
+# потокқа байланған: update өңделер алдында қолданушының қоймасы қойылады,
+# db() және кэштер соған қарай бағытталады. Қойма қойылмаған жерде (іске қосу,
+# ескі скрипттер) — негізгі қойма (DB_PATH).
+REGISTRY_PATH = os.getenv("REGISTRY_PATH", "registry.db")
+TENANTS_DIR = os.getenv("TENANTS_DIR", "tenants")
+DEFAULT_TENANT = "main"
+TENANT_CODE_RE = re.compile(r"[a-z0-9_-]{1,32}")
+
+Tenant = namedtuple("Tenant", "id code name db_path")
+
+class TenantRegistry:
+    def __init__(self, path=REGISTRY_PATH):
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False, factory=TimedConnection)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute("PRAGMA busy_timeout=5000")
+        with self._con:
+            self._con.execute("""
+            CREATE TABLE IF NOT EXISTS tenants(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                db_path TEXT NOT NULL UNIQUE
+            )
+            """)
+            self._con.execute("""
+            CREATE TABLE IF NOT EXISTS tenant_users(
+                uid INTEGER NOT NULL,
+                tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+                PRIMARY KEY (uid, tenant_id)
+            )
+            """)
+            self._con.execute("CREATE INDEX IF NOT EXISTS idx_tenant_users_tenant ON tenant_users(tenant_id, uid)")
+            # бірнеше қоймаға қосылған қолданушының таңдауы
+            self._con.execute("""
+            CREATE TABLE IF NOT EXISTS user_tenant(
+                uid INTEGER PRIMARY KEY,
+                tenant_id INTEGER NOT NULL REFERENCES tenants(id)
+            )
+            """)
+            if self._con.execute("SELECT 1 FROM tenants LIMIT 1").fetchone() is None:
+                tid = self._con.execute(
+                    "INSERT INTO tenants(code, name, db_path) VALUES(?,?,?)",
+                    (DEFAULT_TENANT, "Негізгі қойма", DB_PATH)
+                ).lastrowid
+                self._con.executemany(
+                    "INSERT INTO tenant_users(uid, tenant_id) VALUES(?,?)", [(uid, tid) for uid in ALLOWED_USERS]
+                )
+        self._version = None
+        self._tenants = {}
+        self._users = {}   # uid -> Tenant | None (кэш)
+        self._refresh()
+
+    # басқа процесс registry-ге жазса data_version өзгереді — кэшті қайта оқимыз
+    def _refresh(self):
+        version = self._con.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._version:
+            return
+        self._version = version
+        self._tenants = {row[0]: Tenant(*row) for row in self._con.execute(
+            "SELECT id, code, name, db_path FROM tenants ORDER BY id"
+        )}
+        self._users.clear()
+
+    def _changed(self):
+        self._version = None
+        self._refresh()
+
+    def default(self):
+        with self._lock:
+            self._refresh()
+            return next(iter(self._tenants.values()))
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            return list(self._tenants.values())
+
+    def by_code(self, code):
+        return next((t for t in self.all() if t.code == code), None)
+
+    # Таңдалған қойма, болмаса бірінші мүшелік; әкімші ешбір қоймада болмаса — негізгі
+    def for_user(self, uid):
+        with self._lock:
+            self._refresh()
+            if uid in self._users:
+                return self._users[uid]
+            row = self._con.execute("""
+            SELECT COALESCE(
+                (SELECT s.tenant_id FROM user_tenant s JOIN tenant_users m
+                    ON m.uid = s.uid AND m.tenant_id = s.tenant_id WHERE s.uid = ?),
+                (SELECT MIN(tenant_id) FROM tenant_users WHERE uid = ?)
+            )
+            """, (uid, uid)).fetchone()
+            tenant = self._tenants.get(row[0])
+            if tenant is None and uid in ADMIN_IDS:
+                tenant = next(iter(self._tenants.values()))
+            self._users[uid] = tenant
+            return tenant
+
+    def memberships(self, uid):
+        with self._lock:
+            self._refresh()
+            ids = [r[0] for r in self._con.execute("SELECT tenant_id FROM tenant_users WHERE uid=?", (uid,))]
+            return [self._tenants[i] for i in sorted(ids) if i in self._tenants]
+
+    def members(self, tenant):
+        with self._lock:
+            return [r[0] for r in self._con.execute(
+                "SELECT uid FROM tenant_users WHERE tenant_id=? ORDER BY uid", (tenant.id,)
+            )]
+
+    def user_counts(self):
+        with self._lock:
+            return dict(self._con.execute("SELECT tenant_id, COUNT(*) FROM tenant_users GROUP BY tenant_id"))
+
+    def add(self, code, name):
+        os.makedirs(TENANTS_DIR, exist_ok=True)
+        path = os.path.join(TENANTS_DIR, f"{code}.db")
+        with self._lock:
+            with self._con:
+                tid = self._con.execute(
+                    "INSERT INTO tenants(code, name, db_path) VALUES(?,?,?)", (code, name, path)
+                ).lastrowid
+            self._changed()
+            return self._tenants[tid]
+
+    def add_user(self, uid, tenant):
+        with self._lock:
+            with self._con:
+                self._con.execute("INSERT OR IGNORE INTO tenant_users(uid, tenant_id) VALUES(?,?)", (uid, tenant.id))
+            self._changed()
+
+    def remove_user(self, uid, tenant):
+        with self._lock:
+            with self._con:
+                self._con.execute("DELETE FROM tenant_users WHERE uid=? AND tenant_id=?", (uid, tenant.id))
+                self._con.execute("DELETE FROM user_tenant WHERE uid=? AND tenant_id=?", (uid, tenant.id))
+            self._changed()
+
+    def switch(self, uid, tenant):
+        with self._lock:
+            with self._con:
+                self._con.execute(
+                    "INSERT INTO user_tenant(uid, tenant_id) VALUES(?,?) "
+                    "ON CONFLICT(uid) DO UPDATE SET tenant_id = excluded.tenant_id",
+                    (uid, tenant.id)
+                )
+            self._changed()
+
+tenants = TenantRegistry()
+_tenant_local = threading.local()
+
+def current_tenant():
+    return getattr(_tenant_local, "tenant", None) or tenants.default()
+
+@contextmanager
+def tenant_scope(tenant):
+    prev = getattr(_tenant_local, "tenant", None)
+    _tenant_local.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _tenant_local.tenant = prev
+
+def is_allowed(uid):
+    return tenants.for_user(uid) is not None
+
+# Хабарламалар мен дайджест: әкімшілер + ағымдағы қойманың қолданушылары
+def tenant_recipients():
+    return sorted(ADMIN_IDS | set(tenants.members(current_tenant())))
+
+def tenant_tag():
+    return f"🏬 {current_tenant().name}\n" if len(tenants.all()) > 1 else ""
+
+# Жадтағы қойма-тәуелді объект (кэш, күнтізбе): әр қоймаға жеке дана,
+# атрибуттар ағымдағы қойманың данасына бағытталады.
+class PerTenant:
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def current(self):
+        key = current_tenant().id
+        obj = self._items.get(key)
+        if obj is None:
+            with self._lock:
+                obj = self._items.setdefault(key, self._factory())
+        return obj
+
+    def all(self):
+        return list(self._items.values())
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __len__(self):
+        return len(self.current())
 
 # --------- DB ----------
+# Әр потокқа бір тұрақты қосылым: connect/close және page cache-ті
+# әр хабарлама сайын қайта қыздырмаймыз.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",       # WAL режимінде қауіпсіз, fsync азаяды
+    "PRAGMA cache_size=-16000",        # ~16 MB page cache
+    "PRAGMA mmap_size=268435456",      # 256 MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",          # movements.product_id → products(id)
+)
+DB_STATEMENT_CACHE = 256  # prepared statement кэші (қосылым сайын)
+
+_db_local = threading.local()
+_bootstrap_lock = threading.Lock()
+_bootstrapped = set()
+
+# Ағымдағы қойманың файлына қосылым (поток сайын, файл сайын бір). Файлға
+# процесте алғаш қосылғанда схема дайындалады.
 def db():
-    return sqlite3.connect(DB_PATH)
-
-def init_db():
-    con = db()
-    cur = con.cursor()
+    path = current_tenant().db_path
+    cons = getattr(_db_local, "cons", None)
+    if cons is None:
+        cons = _db_local.cons = {}
+    con = cons.get(path)
+    if con is None:
+        con = sqlite3.connect(path, cached_statements=DB_STATEMENT_CACHE, factory=TimedConnection)
+        for pragma in DB_PRAGMAS:
+            con.execute(pragma)
+        con.create_function("fold_text", 1, fold_text, deterministic=True)
+        cons[path] = con
+    if path not in _bootstrapped:
+        with _bootstrap_lock:
+            if path not in _bootstrapped:
+                init_db(con)
+                _bootstrapped.add(path)
+    return con
+
+# --------- ІЗДЕУ ИНДЕКСІ (FTS5 trigram) ----------
+# Қазақ әріптерін орыс негізіне келтіреміз: қазақша пернетақтасыз терілген
+# "кант" сұрауы "Қант" табуы үшін. Регистрді trigram токенизаторы өзі бүктейді
+# (SQLite LIKE тек ASCII бүктейді).
+KZ_FOLD = {"ә": "а", "ғ": "г", "қ": "к", "ң": "н", "ө": "о", "ұ": "у", "ү": "у", "һ": "х", "і": "и", "i": "и", "ё": "е"}
+_KZ_FOLD_TABLE = str.maketrans(KZ_FOLD)
+
+SEARCH_LIMIT = 20
+FTS_ENABLED = True
+
+def fold_text(text: str) -> str:
+    return text.casefold().translate(_KZ_FOLD_TABLE)
+
+# fold_text-тің SQL нұсқасы — триггерлер сыртқы функциясыз жұмыс істейді
+def fold_sql(expr: str) -> str:
+    for src, dst in KZ_FOLD.items():
+        for ch in (src, src.upper()):
+            expr = f"replace({expr}, '{ch}', '{dst}')"
+    return expr
+
+def init_search_index(cur):
+    exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='products_fts'"
+    ).fetchone()
+    cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(name, tokenize='trigram')")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name) VALUES (new.id, {fold_sql("new.name")});
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN
+        UPDATE products_fts SET name = {fold_sql("new.name")} WHERE rowid = new.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_sd AFTER UPDATE OF deleted_at ON products
+    WHEN new.deleted_at IS NOT NULL BEGIN
+        DELETE FROM products_fts WHERE rowid = new.id;
+    END
+    """)
+    if not exists:
+        cur.execute(
+            f"INSERT INTO products_fts(rowid, name) SELECT id, {fold_sql('name')} FROM products WHERE deleted_at IS NULL"
+        )
 
+# --------- КҮН / УАҚЫТ ----------
+# Базада мерзім — күн нөмірі (date.toordinal()), уақыт — unix epoch секунд.
+# Салыстыру мен диапазон сүзгілері сан бойынша; мәтінге тек көрсетерде айналады.
+JD_ORDINAL = 1721424.5   # julianday(...) − JD_ORDINAL = date.toordinal()
+
+def now_ts():
+    return int(time.time())
+
+def day_start_ts(d: date):
+    return int(datetime.combine(d, datetime.min.time()).timestamp())
+
+def parse_day(text: str):
+    return datetime.strptime(text, "%Y-%m-%d").toordinal()
+
+def fmt_day(day):
+    return date.fromordinal(day).isoformat() if day else None
+
+def fmt_ts(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+# epoch бағанынан жергілікті күн нөмірі (SQL)
+def local_day_sql(col: str) -> str:
+    return f"CAST(julianday({col}, 'unixepoch', 'localtime') - {JD_ORDINAL} AS INTEGER)"
+
+# --------- МАТЕРИАЛДАНҒАН САНАУЫШТАР (📊 Статистика) ----------
+# Триггерлер products / movements өзгерген сайын жинақ кестелерді жаңартады,
+# сондықтан статистика экраны COUNT/SUM орнына бір-екі шағын жолды оқиды.
+STATS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_products_ai AFTER INSERT ON products BEGIN
+        UPDATE stats_totals SET product_count = product_count + 1, total_qty = total_qty + new.qty WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_products_ad AFTER DELETE ON products WHEN old.deleted_at IS NULL BEGIN
+        UPDATE stats_totals SET product_count = product_count - 1, total_qty = total_qty - old.qty WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_products_sd AFTER UPDATE OF deleted_at ON products
+    WHEN old.deleted_at IS NULL AND new.deleted_at IS NOT NULL BEGIN
+        UPDATE stats_totals SET product_count = product_count - 1, total_qty = total_qty - old.qty WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_products_au AFTER UPDATE OF qty ON products BEGIN
+        UPDATE stats_totals SET total_qty = total_qty + new.qty - old.qty WHERE id = 1;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS stats_movements_ai AFTER INSERT ON movements BEGIN
+        UPDATE stats_totals SET movement_count = movement_count + 1 WHERE id = 1;
+        INSERT INTO stats_daily(day, mtype, moves, qty) VALUES ({local_day_sql("new.created_at")}, new.mtype, 1, new.qty)
+        ON CONFLICT(day, mtype) DO UPDATE SET moves = moves + 1, qty = qty + excluded.qty;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS stats_movements_ad AFTER DELETE ON movements
+    WHEN old.id > COALESCE((SELECT upto FROM archive_state WHERE id = 1), 0) BEGIN
+        UPDATE stats_totals SET movement_count = movement_count - 1 WHERE id = 1;
+        UPDATE stats_daily SET moves = moves - 1, qty = qty - old.qty
+        WHERE day = {local_day_sql("old.created_at")} AND mtype = old.mtype;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS stats_movements_au AFTER UPDATE OF mtype, qty, created_at ON movements BEGIN
+        UPDATE stats_daily SET moves = moves - 1, qty = qty - old.qty
+        WHERE day = {local_day_sql("old.created_at")} AND mtype = old.mtype;
+        INSERT INTO stats_daily(day, mtype, moves, qty) VALUES ({local_day_sql("new.created_at")}, new.mtype, 1, new.qty)
+        ON CONFLICT(day, mtype) DO UPDATE SET moves = moves + 1, qty = qty + excluded.qty;
+    END
+    """,
+)
+
+STATS_DAILY_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    day INTEGER NOT NULL,              -- жергілікті күн, date.toordinal()
+    mtype TEXT NOT NULL,
+    moves INTEGER NOT NULL,
+    qty INTEGER NOT NULL,
+    PRIMARY KEY (day, mtype)
+) WITHOUT ROWID
+"""
+
+def init_stats(cur):
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS products(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        qty INTEGER NOT NULL DEFAULT 0,
-        exp_date TEXT,
-        min_qty INTEGER NOT NULL DEFAULT 0
+    CREATE TABLE IF NOT EXISTS stats_totals(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        product_count INTEGER NOT NULL,
+        total_qty INTEGER NOT NULL,
+        movement_count INTEGER NOT NULL
     )
     """)
+    cur.execute(STATS_DAILY_DDL.format(name="stats_daily"))
+    if cur.execute("SELECT 1 FROM stats_totals WHERE id = 1").fetchone() is None:
+        cur.execute("""
+        INSERT INTO stats_totals(id, product_count, total_qty, movement_count)
+        SELECT 1, (SELECT COUNT(*) FROM products WHERE deleted_at IS NULL),
+               (SELECT COALESCE(SUM(qty), 0) FROM products WHERE deleted_at IS NULL),
+               (SELECT COUNT(*) FROM movements)
+        """)
+        cur.execute("DELETE FROM stats_daily")
+        cur.execute(f"""
+        INSERT INTO stats_daily(day, mtype, moves, qty)
+        SELECT {local_day_sql("created_at")}, mtype, COUNT(*), SUM(qty) FROM movements GROUP BY 1, 2
+        """)
+    for sql in STATS_TRIGGERS:
+        cur.execute(sql)
+
+def period_totals(since: int):
+    return {
+        mtype: (moves, qty) for mtype, moves, qty in db().execute(
+            "SELECT mtype, SUM(moves), SUM(qty) FROM stats_daily WHERE day >= ? GROUP BY mtype", (since,)
+        )
+    }
+
+# --------- СХЕМА ЖӘНЕ МИГРАЦИЯЛАР ----------
+# Схема нұсқасы PRAGMA user_version-да. Файлға процесте алғаш қосылғанда (db())
+# бір рет тексеріледі: жаңа база бірден соңғы схемамен құрылады, ескісіне
+# MIGRATIONS[user_version:] қадамдары қолданылады — бәрі бір транзакцияда.
+PRODUCTS_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    qty INTEGER NOT NULL DEFAULT 0,
+    exp_day INTEGER,                   -- date.toordinal()
+    min_qty INTEGER NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL DEFAULT 0,
+    deleted_at INTEGER                 -- өшірілген уақыты (epoch), NULL — белсенді
+)
+"""
+
+# Тауар жолы өшірілмейді (products.deleted_at), сондықтан тарих product_id-ін
+# сақтайды: /journal <id>, экспорт, күндегі қалдық өшірілген тауарды да көреді
+MOVEMENTS_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_id INTEGER NOT NULL REFERENCES products(id),
+    mtype TEXT NOT NULL,               -- IN / OUT / WRITE_OFF
+    qty INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,       -- unix epoch
+    comment TEXT
+)
+"""
+
+# ескерту жіберілген тауарлар (қайталамау үшін)
+LOW_ALERTS_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    product_id INTEGER PRIMARY KEY,
+    alerted_at INTEGER NOT NULL
+)
+"""
+
+def create_schema(cur):
+    global FTS_ENABLED
+    cur.execute(PRODUCTS_DDL.format(name="products"))
+    cur.execute(MOVEMENTS_DDL.format(name="movements"))
+
+    # импорт атауы бойынша upsert жасайды
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products(name) WHERE deleted_at IS NULL")
+
+    # мерзім диапазоны (ExpiryCalendar) индекс бойынша
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_products_exp ON products(exp_day, id) "
+        "WHERE exp_day IS NOT NULL AND deleted_at IS NULL"
+    )
+
+    # журнал сүзгілері: тауар / түр бойынша keyset, күн аралығы; (product_id, id) — FK индексі де
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movements_product ON movements(product_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movements_type ON movements(mtype, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movements_created ON movements(created_at)")
 
+    # Аз қалды: тек min қойылған тауарлар, LOW_STOCK_SQL үшін covering индекс.
+    # deleted_at partial шартта болса да бағанға керек: әйтпесе SQLite кестені де оқиды
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_products_low
+    ON products(qty - min_qty, qty, min_qty, name, deleted_at) WHERE min_qty > 0 AND deleted_at IS NULL
+    """)
+    cur.execute(LOW_ALERTS_DDL.format(name="low_alerts"))
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS low_alerts_products_ad AFTER DELETE ON products BEGIN
+        DELETE FROM low_alerts WHERE product_id = old.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS low_alerts_products_sd AFTER UPDATE OF deleted_at ON products
+    WHEN new.deleted_at IS NOT NULL BEGIN
+        DELETE FROM low_alerts WHERE product_id = new.id;
+    END
+    """)
+
+    # updated_at — фондық тапсырмалардың watermark-ы (тек өзгергенін қайта қарау үшін)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_updated ON products(updated_at)")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_touch_ai AFTER INSERT ON products BEGIN
+        UPDATE products SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = new.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_touch_au AFTER UPDATE OF name, qty, exp_day, min_qty, deleted_at ON products BEGIN
+        UPDATE products SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = new.id;
+    END
+    """)
+
+    try:
+        init_search_index(cur)
+    except sqlite3.OperationalError as e:
+        # SQLite FTS5/trigram-сыз құрастырылған болса — LIKE іздеуі қалады
+        print(f"FTS5 search disabled: {e}")
+        FTS_ENABLED = False
+
+    init_compaction(cur)
+    init_stats(cur)
+
+    # адамға оқылатын көріністер: экспорт және sqlite3 арқылы қолмен қарау
+    cur.execute(f"""
+    CREATE VIEW IF NOT EXISTS products_v AS
+    SELECT id, name, qty, date(exp_day + {JD_ORDINAL}) AS exp_date, min_qty,
+           datetime(updated_at, 'unixepoch', 'localtime') AS updated_at,
+           datetime(deleted_at, 'unixepoch', 'localtime') AS deleted_at
+    FROM products
+    """)
+    cur.execute("""
+    CREATE VIEW IF NOT EXISTS movements_v AS
+    SELECT id, product_id, mtype, qty, created_at AS created_ts,
+           datetime(created_at, 'unixepoch', 'localtime') AS created_at, comment
+    FROM movements
+    """)
+
+# SQLite бағанның түрін өзгерте алмайды: жаңа кесте құрып, көшіріп, ауыстырамыз
+def rebuild_table(cur, table, ddl, select_sql):
+    cur.execute(ddl.format(name=f"{table}_new"))
+    cur.execute(f"INSERT INTO {table}_new {select_sql}")
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(f"ALTER TABLE {table}_new RENAME TO {table.split('.')[-1]}")
+
+def table_columns(cur, table, schema="main"):
+    return {row[1] for row in cur.execute(f"PRAGMA {schema}.table_info({table})")}
+
+# мәтін уақыт ("YYYY-MM-DD HH:MM:SS", жергілікті) → epoch
+def text_ts_sql(col: str) -> str:
+    return f"CAST(strftime('%s', {col}, 'utc') AS INTEGER)"
+
+# Оқылмайтын мән болса миграция тоқтайды (транзакция қайтарылады) — деректі үнсіз
+# NULL/0-ге айналдырмаймыз, мәнді қолмен түзетіп, қайта іске қосу керек.
+def check_text_ts(cur, table, col):
+    bad = cur.execute(f"SELECT rowid, {col} FROM {table} WHERE strftime('%s', {col}) IS NULL LIMIT 20").fetchall()
+    if bad:
+        raise RuntimeError(f"{table}.{col}: unparseable timestamps {bad}; fix them and restart")
+
+# Ескі мерзім мәтіні қосу/өңдеу ағындары тексерген форматпен оқылады: strptime
+# "2026-2-5" сияқты нөлсіз күнді де қабылдайды, SQLite julianday — жоқ.
+def legacy_exp_days(cur):
+    days, bad = [], []
+    for pid, exp in cur.execute("SELECT id, exp_date FROM products WHERE exp_date IS NOT NULL"):
+        exp = str(exp).strip()
+        if exp in ("", "-"):
+            continue
+        try:
+            days.append((parse_day(exp.split()[0]), pid))
+        except ValueError:
+            bad.append((pid, exp))
+    if bad:
+        raise RuntimeError(f"products.exp_date: unparseable dates {bad[:20]} ({len(bad)} rows); fix them and restart")
+    return days
+
+# Бұрын жолымен өшірілген тауарлардың қозғалыстары id-ін сақтайды: оларға
+# "өшірілген" жол қайта жасалады (сыртқы кілт үшін). Қалдығы — соңғы snapshot +
+# одан кейінгі қозғалыстар, сонда күндегі қалдық snapshot-тан да, қазіргі күйден
+# де бірдей есептеледі.
+def restore_deleted_products(cur):
+    orphans = [row[0] for row in cur.execute(
+        "SELECT DISTINCT product_id FROM movements WHERE product_id NOT IN (SELECT id FROM products)"
+    )]
+    has_snapshots = bool(table_columns(cur, "snapshot_items"))
+    rows = []
+    for pid in orphans:
+        qty, last = 0, 0
+        if has_snapshots:
+            row = cur.execute(
+                "SELECT i.qty, s.last_movement_id FROM snapshot_items i JOIN stock_snapshots s ON s.id = i.snap_id "
+                "WHERE i.product_id = ? ORDER BY i.snap_id DESC LIMIT 1", (pid,)
+            ).fetchone()
+            if row:
+                qty, last = row
+        qty += cur.execute(
+            "SELECT COALESCE(SUM(CASE WHEN mtype = 'IN' THEN qty ELSE -qty END), 0) FROM movements "
+            "WHERE product_id = ? AND id > ?", (pid, last)
+        ).fetchone()[0]
+        rows.append((pid, "", qty, now_ts()))
+    cur.executemany("INSERT INTO products(id, name, qty, deleted_at) VALUES(?,?,?,?)", rows)
+
+# v1: мәтін күндер → сандар, movements.product_id → products(id) сыртқы кілті,
+# тауар өшіру — deleted_at. Ескі базада кейінгі кестелер мен бағандар әлі болмауы
+# мүмкін. AUTOINCREMENT санағыштары сақталады (id қайталанбайды).
+def migrate_v1_int_dates(cur):
+    seqs = dict(cur.execute("SELECT name, seq FROM sqlite_sequence"))
+    cols = table_columns(cur, "products")
+    exp_days = legacy_exp_days(cur)
+    rebuild_table(cur, "products", PRODUCTS_DDL, f"""
+        SELECT id, name, qty, NULL, min_qty, {"updated_at" if "updated_at" in cols else 0}, NULL
+        FROM products
+    """)
+    cur.executemany("UPDATE products SET exp_day = ? WHERE id = ?", exp_days)
+    if table_columns(cur, "movements"):
+        check_text_ts(cur, "movements", "created_at")
+        restore_deleted_products(cur)
+        rebuild_table(cur, "movements", MOVEMENTS_DDL, f"""
+            SELECT id, product_id, mtype, qty, {text_ts_sql("created_at")}, comment
+            FROM movements
+        """)
+    if table_columns(cur, "low_alerts"):
+        check_text_ts(cur, "low_alerts", "alerted_at")
+        rebuild_table(cur, "low_alerts", LOW_ALERTS_DDL,
+                      f"SELECT product_id, {text_ts_sql('alerted_at')} FROM low_alerts")
+    if table_columns(cur, "stock_snapshots"):
+        check_text_ts(cur, "stock_snapshots", "taken_at")
+        rebuild_table(cur, "stock_snapshots", SNAPSHOTS_DDL,
+                      f"SELECT id, {text_ts_sql('taken_at')}, last_movement_id FROM stock_snapshots")
+    if table_columns(cur, "stats_daily"):
+        rebuild_table(cur, "stats_daily", STATS_DAILY_DDL,
+                      f"SELECT CAST(julianday(day) - {JD_ORDINAL} AS INTEGER), mtype, moves, qty FROM stats_daily")
+    for name in ("products", "movements", "stock_snapshots"):
+        if name in seqs and not cur.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seqs[name], name)
+        ).rowcount:
+            cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?,?)", (name, seqs[name]))
+
+# v2: idx_products_name (импорт атауы бойынша upsert) — оны create_schema қосады
+def migrate_v2_name_index(cur):
+    pass
+
+# v3: idx_products_low-қа deleted_at қосылды (covering) — ескісін тастаймыз, create_schema қайта құрады
+def migrate_v3_low_index(cur):
+    cur.execute("DROP INDEX IF EXISTS idx_products_low")
+
+MIGRATIONS = (migrate_v1_int_dates, migrate_v2_name_index, migrate_v3_low_index)   # i-ші қадам базаны i+1 нұсқаға көтереді
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(con):
+    if con.in_transaction:
+        con.commit()
+    # кестелерді қайта құрғанда FK тексерілмейді (PRAGMA транзакция ішінде әсер етпейді)
+    con.execute("PRAGMA foreign_keys=OFF")
+    try:
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            # басқа процесс бізден бұрын көтерген болуы мүмкін
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+            cur = con.cursor()
+            if table_columns(cur, "products"):
+                for step in MIGRATIONS[version:]:
+                    step(cur)
+            create_schema(cur)
+            broken = cur.execute("PRAGMA foreign_key_check").fetchall()
+            if broken:
+                raise sqlite3.IntegrityError(f"foreign key check failed: {broken[:5]}")
+            cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        print(f"DB {current_tenant().db_path}: schema {version} -> {SCHEMA_VERSION}")
+    finally:
+        con.execute("PRAGMA foreign_keys=ON")
+
+def init_db(con=None):
+    global FTS_ENABLED
+    con = con or db()
+    if con.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        migrate(con)
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='products_fts'").fetchone() is None:
+        FTS_ENABLED = False
+
+# Іске қосылғанда барлық қойма базасын дайындаймыз (db() әр файлды бір рет көтереді)
+def init_tenant_dbs():
+    for tenant in tenants.all():
+        with tenant_scope(tenant):
+            db()
+
+# --------- ҚАЛДЫҚ ӨЗГЕРТУ (бір транзакция) ----------
+# IN қалдықты көбейтеді, OUT / WRITE_OFF азайтады
+MOVEMENT_SIGN = {"IN": 1, "OUT": -1, "WRITE_OFF": -1}
+
+# Қалдықты өзгертіп, журналға жазады да жаңа (name, qty, min_qty) қайтарады.
+# Тауар жоқ болса немесе қалдық жетпесе None — ештеңе өзгермейді.
+def apply_movement(pid: int, mtype: str, qty: int, comment: str = ""):
+    sign = MOVEMENT_SIGN[mtype]
+    need = qty if sign < 0 else 0
+    con = db()
+    with con:
+        # шарт (qty >= ?) UPDATE ішінде: тексеру мен жазу арасында жарыс жоқ
+        row = con.execute(
+            "UPDATE products SET qty = qty + ? WHERE id = ? AND qty >= ? AND deleted_at IS NULL "
+            "RETURNING name, qty, min_qty",
+            (sign * qty, pid, need)
+        ).fetchone()
+        if row is None:
+            return None
+        con.execute(
+            "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)",
+            (pid, mtype, qty, now_ts(), comment)
+        )
+    name, new_qty, minq = row
+    stock_changed(pid, name, new_qty - sign * qty, new_qty, minq, minq)
+    return row
+
+# Көп жолды операция: бәрі бір транзакцияда, не бәрі өтеді, не ештеңе.
+# items = [(pid, qty, comment), ...]. Сәтті болса ([(pid, name, qty, new_qty), ...], [])
+# қайтарады, әйтпесе (None, [қате мәтіндері]).
+def apply_batch(mtype: str, items):
+    sign = MOVEMENT_SIGN[mtype]
+    need = {}
+    for pid, qty, _ in items:
+        need[pid] = need.get(pid, 0) + qty
+    con = db()
+    now = now_ts()
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        prods = products_by_ids(list(need))
+        errors = []
+        for pid, qty in need.items():
+            prod = prods.get(pid)
+            if prod is None:
+                errors.append(f"ID:{pid} табылмады")
+            elif sign < 0 and prod[2] < qty:
+                errors.append(f"ID:{pid} {prod[1]} — қалдық {prod[2]}, керегі {qty}")
+        if errors:
+            return None, errors
+        con.executemany(
+            "UPDATE products SET qty = qty + ? WHERE id = ?",
+            [(sign * qty, pid) for pid, qty in need.items()]
+        )
+        con.executemany(
+            "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)",
+            [(pid, mtype, qty, now, comment) for pid, qty, comment in items]
+        )
+    result = []
+    for pid, qty in need.items():
+        _, name, old_qty, _, minq = prods[pid]
+        new_qty = old_qty + sign * qty
+        result.append((pid, name, qty, new_qty))
+        stock_changed(pid, name, old_qty, new_qty, minq, minq)
+    return result, []
+
+# --------- ҚАЛДЫҚ ОҚИҒАЛАРЫ ----------
+# Қалдық немесе min өзгерген сайын (коммиттен кейін) шақырылады:
+# hook(pid, name, old_qty, new_qty, old_min, new_min)
+STOCK_HOOKS = []
+
+def on_stock_change(fn):
+    STOCK_HOOKS.append(fn)
+    return fn
+
+def stock_changed(pid, name, old_qty, new_qty, old_min, new_min):
+    for hook in STOCK_HOOKS:
+        try:
+            hook(pid, name, old_qty, new_qty, old_min, new_min)
+        except Exception as e:
+            print(f"stock hook {hook.__name__} failed: {e}")
+
+def is_low(qty, minq):
+    return minq > 0 and qty <= minq
+
+LOW_STOCK_SQL = (
+    "SELECT id, name, qty, min_qty FROM products "
+    "WHERE min_qty > 0 AND deleted_at IS NULL AND qty - min_qty <= 0 ORDER BY qty ASC"
+)
+
+# Шекті кесіп өткенде ғана әрекет етеміз: төмен түссе — қойма қолданушыларына бір
+# ескерту (low_alerts қайталатпайды), қайта көтерілсе — ескертуді қайта қосамыз.
+@on_stock_change
+def low_stock_watch(pid, name, old_qty, new_qty, old_min, new_min):
+    was_low, now_low = is_low(old_qty, old_min), is_low(new_qty, new_min)
+    if was_low == now_low:
+        return
+    con = db()
+    if not now_low:
+        with con:
+            con.execute("DELETE FROM low_alerts WHERE product_id=?", (pid,))
+        return
+    with con:
+        cur = con.execute(
+            "INSERT OR IGNORE INTO low_alerts(product_id, alerted_at) VALUES(?,?)", (pid, now_ts())
+        )
+    if cur.rowcount:
+        for uid in tenant_recipients():
+            try:
+                bot.send_message(uid, f"{tenant_tag()}⚠️ Аз қалды: ID:{pid} | {name} — {new_qty} дана (min:{new_min})")
+            except Exception as e:
+                print(f"low stock alert to {uid} failed: {e}")
+
+# --------- МЕРЗІМ КҮНТІЗБЕСІ ----------
+# Жадтағы сұрыпталған (exp_day, id) тізімі. Бірінші сұрауда бір рет
+# индекс бойынша жүктеледі, кейін қосу/өңдеу/өшіру оны өзі жаңартып отырады.
+# sync() басқа процестер өзгерткен тауарларды updated_at watermark бойынша алады.
+class ExpiryCalendar:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = []
+        self._by_pid = {}
+        self._loaded = False
+        self._watermark = 0
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._watermark = int(time.time())
+        rows = db().execute(
+            "SELECT exp_day, id FROM products WHERE exp_day IS NOT NULL AND deleted_at IS NULL "
+            "ORDER BY exp_day, id"
+        ).fetchall()
+        self._items = rows
+        self._by_pid = {pid: exp for exp, pid in rows}
+        self._loaded = True
+
+    def sync(self):
+        with self._lock:
+            if not self._loaded:
+                return
+            since, self._watermark = self._watermark, int(time.time())
+            changed = db().execute(
+                "SELECT id, CASE WHEN deleted_at IS NULL THEN exp_day END FROM products WHERE updated_at >= ?",
+                (since,)
+            ).fetchall()
+            for pid, exp in changed:
+                self._set(pid, exp)
+
+    def set(self, pid: int, exp):
+        with self._lock:
+            if self._loaded:
+                self._set(pid, exp)
+
+    def _set(self, pid, exp):
+        old = self._by_pid.pop(pid, None)
+        if old is not None:
+            del self._items[bisect_left(self._items, (old, pid))]
+        if exp:
+            insort(self._items, (exp, pid))
+            self._by_pid[pid] = exp
+
+    def discard(self, pid: int):
+        self.set(pid, None)
+
+    def within(self, days: int = EXP_HORIZON_DAYS):
+        limit = (date.today() + timedelta(days=days)).toordinal()
+        with self._lock:
+            self._ensure_loaded()
+            return self._items[:bisect_right(self._items, (limit, float("inf")))]
+
+exp_calendar = PerTenant(ExpiryCalendar)
+
+# --------- ҚАЛДЫҚ ТАРИХЫ (snapshot + архив) ----------
+# Snapshot — movement id шекарасындағы қалдықтар. Алғашқысы толық, кейінгілері
+# тек алдыңғыдан бері қозғалысы болған тауарлар (тауардың сол сәттегі қалдығы —
+# оның snap_id <= S ең соңғы жазбасы). Ескі қозғалыстар <db>.archive.db файлына
+# көшеді: id <= archive_state.upto — архивте, қалғаны негізгі базада.
+# Күндегі қалдық = ең жақын snapshot ± арадағы қозғалыстар, толық журнал оқылмайды.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))   # 0 — архивтемеу
+ARCHIVE_CHUNK = 20000
+
+SNAPSHOTS_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    taken_at INTEGER NOT NULL,
+    last_movement_id INTEGER NOT NULL
+)
+"""
+
+# архив бөлек файл: сыртқы кілтсіз, өз user_version-ы бар
+ARCHIVE_MOVEMENTS_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER,
+    mtype TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    comment TEXT
+)
+"""
+ARCHIVE_VERSION = 1
+
+def init_compaction(cur):
+    cur.execute(SNAPSHOTS_DDL.format(name="stock_snapshots"))
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_last ON stock_snapshots(last_movement_id)")
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS movements(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE IF NOT EXISTS snapshot_items(
         product_id INTEGER NOT NULL,
-        mtype TEXT NOT NULL,               -- IN / OUT / WRITE_OFF
+        snap_id INTEGER NOT NULL,
         qty INTEGER NOT NULL,
-        created_at TEXT NOT NULL,
-        comment TEXT
+        PRIMARY KEY (product_id, snap_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_snapshot_items_snap ON snapshot_items(snap_id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS archive_state(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        upto INTEGER NOT NULL
     )
     """)
+    cur.execute("INSERT OR IGNORE INTO archive_state(id, upto) VALUES(1, 0)")
 
-    con.commit()
-    con.close()
+def archive_path():
+    return os.path.splitext(current_tenant().db_path)[0] + ".archive.db"
 
-def log_movement(product_id: int, mtype: str, qty: int, comment: str = ""):
+def attach_archive(con):
+    if any(row[1] == "archive" for row in con.execute("PRAGMA database_list")):
+        return
+    con.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+    con.execute("PRAGMA archive.journal_mode=WAL")
+    if con.execute("PRAGMA archive.user_version").fetchone()[0] >= ARCHIVE_VERSION:
+        return
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        cur = con.cursor()
+        if cur.execute("PRAGMA archive.user_version").fetchone()[0] < ARCHIVE_VERSION:
+            # v0 архивінде created_at мәтін
+            if table_columns(cur, "movements", "archive"):
+                check_text_ts(cur, "archive.movements", "created_at")
+                rebuild_table(cur, "archive.movements", ARCHIVE_MOVEMENTS_DDL, f"""
+                    SELECT id, product_id, mtype, qty, {text_ts_sql("created_at")}, comment
+                    FROM archive.movements
+                """)
+            cur.execute(ARCHIVE_MOVEMENTS_DDL.format(name="archive.movements"))
+            cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_product ON movements(product_id, id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_created ON movements(created_at)")
+            cur.execute(f"PRAGMA archive.user_version = {ARCHIVE_VERSION}")
+
+def archived_upto(con):
+    return con.execute("SELECT upto FROM archive_state WHERE id = 1").fetchone()[0]
+
+# (lo, hi] id аралығындағы қозғалыстардың қалдыққа әсері: {pid: ±qty}
+def movement_deltas(lo, hi, pid=None):
     con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)",
-        (product_id, mtype, qty, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), comment)
-    )
-    con.commit()
-    con.close()
+    upto = archived_upto(con)
+    ranges = []
+    if lo < upto:
+        attach_archive(con)
+        ranges.append(("archive.movements", lo, min(hi, upto)))
+    if hi > upto:
+        ranges.append(("movements", max(lo, upto), hi))
+    out = {}
+    for table, a, b in ranges:
+        sql = (f"SELECT product_id, SUM(CASE WHEN mtype = 'IN' THEN qty ELSE -qty END) FROM {table} "
+               f"WHERE {'product_id = ?' if pid is not None else 'product_id IS NOT NULL'} "
+               f"AND id > ? AND id <= ? GROUP BY product_id")
+        for p, delta in con.execute(sql, ((pid,) if pid is not None else ()) + (a, b)):
+            out[p] = out.get(p, 0) + delta
+    return out
+
+# Берілген уақытқа (epoch) дейінгі соңғы қозғалыстың id-і (жоқ болса 0)
+def movement_id_before(ts):
+    con = db()
+    row = con.execute(
+        "SELECT id FROM movements WHERE created_at < ? ORDER BY created_at DESC, id DESC LIMIT 1", (ts,)
+    ).fetchone()
+    if row is None and archived_upto(con):
+        attach_archive(con)
+        row = con.execute(
+            "SELECT id FROM archive.movements WHERE created_at < ? ORDER BY created_at DESC, id DESC LIMIT 1", (ts,)
+        ).fetchone()
+    return row[0] if row else 0
+
+def snapshot_state(snap_id, pid=None):
+    con = db()
+    if pid is not None:
+        row = con.execute(
+            "SELECT qty FROM snapshot_items WHERE product_id = ? AND snap_id <= ? ORDER BY snap_id DESC LIMIT 1",
+            (pid, snap_id)
+        ).fetchone()
+        return {pid: row[0]} if row else {}
+    # SQLite: MAX() бар топта жай бағандар сол max жолынан алынады
+    return {p: qty for p, qty, _ in con.execute(
+        "SELECT product_id, qty, MAX(snap_id) FROM snapshot_items WHERE snap_id <= ? GROUP BY product_id", (snap_id,)
+    )}
+
+def current_state(pid=None):
+    con = db()
+    con.execute("BEGIN")   # қалдық пен sqlite_sequence бір көріністен
+    try:
+        last = con.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='movements'), 0)").fetchone()[0]
+        if pid is not None:
+            rows = con.execute("SELECT id, qty FROM products WHERE id = ?", (pid,))
+        else:
+            rows = con.execute("SELECT id, qty FROM products")
+        return last, dict(rows.fetchall())
+    finally:
+        con.commit()
+
+# bound id-дегі қалдықтар: алдыңғы/кейінгі snapshot немесе қазіргі күй — қайсысы
+# id бойынша жақын болса, содан арадағы қозғалыстарды қосамыз/аламыз
+def stock_at_id(bound, pid=None):
+    con = db()
+    before = con.execute(
+        "SELECT id, last_movement_id FROM stock_snapshots WHERE last_movement_id <= ? "
+        "ORDER BY last_movement_id DESC LIMIT 1", (bound,)
+    ).fetchone()
+    after = con.execute(
+        "SELECT id, last_movement_id FROM stock_snapshots WHERE last_movement_id >= ? "
+        "ORDER BY last_movement_id LIMIT 1", (bound,)
+    ).fetchone()
+    now_last, now_state = current_state(pid)
+    options = [(now_last - bound, "now")]
+    if before:
+        options.append((bound - before[1], "before"))
+    if after:
+        options.append((after[1] - bound, "after"))
+    _, base = min(options)
+
+    if base == "before":
+        state = snapshot_state(before[0], pid)
+        sign, lo, hi = 1, before[1], bound
+    elif base == "after":
+        state = snapshot_state(after[0], pid)
+        sign, lo, hi = -1, bound, after[1]
+    else:
+        state = now_state
+        sign, lo, hi = -1, bound, max(now_last, bound)
+    for p, delta in movement_deltas(lo, hi, pid).items():
+        state[p] = state.get(p, 0) + sign * delta
+    return state
+
+def stock_at_date(day, pid=None):
+    bound = movement_id_before(day_start_ts(day + timedelta(days=1)))
+    return stock_at_id(bound, pid)
+
+def take_snapshot():
+    con = db()
+    con.execute("BEGIN")   # оқу транзакциясы: қалдықтар дәл last id-ге сай
+    try:
+        last = con.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='movements'), 0)").fetchone()[0]
+        prev = con.execute("SELECT last_movement_id FROM stock_snapshots ORDER BY id DESC LIMIT 1").fetchone()
+        if prev is not None and prev[0] == last:
+            return None
+        if prev is None:
+            rows = con.execute("SELECT id, qty FROM products").fetchall()
+        else:
+            rows = con.execute(
+                "SELECT id, qty FROM products WHERE id IN "
+                "(SELECT DISTINCT product_id FROM movements WHERE id > ? AND id <= ?)", (prev[0], last)
+            ).fetchall()
+    finally:
+        con.commit()
+    with con:
+        snap_id = con.execute(
+            "INSERT INTO stock_snapshots(taken_at, last_movement_id) VALUES(?,?)", (now_ts(), last)
+        ).lastrowid
+        con.executemany(
+            "INSERT INTO snapshot_items(product_id, snap_id, qty) VALUES(?,?,?)",
+            [(pid, snap_id, qty) for pid, qty in rows]
+        )
+    return snap_id, len(rows)
+
+# Архивке тек соңғы snapshot-қа дейінгі және ARCHIVE_AFTER_DAYS-тан ескі қозғалыстар.
+# Әр бөлік: алдымен архивке көшіріп коммиттейміз, сосын негізгі базада upto-ны
+# жылжытып жоямыз — арада құласа, артық көшірме id > upto болғандықтан есептелмейді.
+def archive_movements(days=ARCHIVE_AFTER_DAYS):
+    con = db()
+    cut = movement_id_before(now_ts() - days * 86400)
+    snap = con.execute("SELECT MAX(last_movement_id) FROM stock_snapshots").fetchone()[0] or 0
+    cut = min(cut, snap)
+    upto = archived_upto(con)
+    moved = 0
+    if upto >= cut:
+        return 0
+    attach_archive(con)
+    while upto < cut:
+        hi = min(cut, upto + ARCHIVE_CHUNK)
+        with con:
+            con.execute(
+                "INSERT OR IGNORE INTO archive.movements(id, product_id, mtype, qty, created_at, comment) "
+                "SELECT id, product_id, mtype, qty, created_at, comment FROM main.movements WHERE id > ? AND id <= ?",
+                (upto, hi)
+            )
+        with con:
+            con.execute("UPDATE archive_state SET upto = ? WHERE id = 1", (hi,))
+            moved += con.execute("DELETE FROM main.movements WHERE id > ? AND id <= ?", (upto, hi)).rowcount
+        upto = hi
+    return moved
+
+def compact():
+    snap = take_snapshot()
+    moved = archive_movements() if ARCHIVE_AFTER_DAYS > 0 else 0
+    return snap, moved
 
 # --------- UI ----------
 def main_kb():
@@ -78,70 +1542,416 @@ def main_kb():
         types.KeyboardButton("✏️ Тауар өңдеу"),
         types.KeyboardButton("⚠️ Аз қалды"),
         types.KeyboardButton("🧾 Журнал"),
+        types.KeyboardButton("📋 Топтама"),
+        types.KeyboardButton("📈 Болжам"),
     )
     return kb
 
-# --------- STATES (simple dict) ----------
-# user_state[user_id] = {"step": "...", "data": {...}}
-user_state = {}
+# --------- STATES ----------
+# state = {"step": "...", "data": {...}}
+# STATE_BACKEND=sqlite (әдепкі): күй әр қойманың <db>.state.db файлында сақталады —
+# рестарттан кейін де, бірнеше gunicorn worker арасында да ортақ, ал қоймалар бір-бірінің
+# жазу құлпын күтпейді. Алдында LRU кэш тұрады.
+# STATE_BACKEND=memory: бір процесс, бұрынғыдай жадта ғана.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_TTL = int(os.getenv("STATE_TTL", "3600"))            # тасталған ағын қанша секундта өшеді
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "1024"))
+
+class MemoryStateStore:
+    def __init__(self, ttl=STATE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, uid):
+        with self._lock:
+            item = self._items.get(uid)
+            if item is None:
+                return None
+            if time.time() - item[2] > self.ttl:
+                del self._items[uid]
+                return None
+            return {"step": item[0], "data": dict(item[1])}
+
+    def set(self, uid, step, data):
+        with self._lock:
+            self._items[uid] = (step, dict(data), time.time())
+
+    def clear(self, uid):
+        with self._lock:
+            self._items.pop(uid, None)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            for uid in [u for u, item in self._items.items() if now - item[2] > self.ttl]:
+                del self._items[uid]
+
+    def __len__(self):
+        return len(self._items)
+
+# Write-through: әр set/clear бірден SQLite-қа жазылады. Оқу LRU кэштен;
+# басқа процесс state.db-ға жазса PRAGMA data_version өзгереді де кэш тазаланады.
+class SqliteStateStore(MemoryStateStore):
+    def __init__(self, path, ttl=STATE_TTL, cache_size=STATE_CACHE_SIZE):
+        super().__init__(ttl)
+        self.cache_size = cache_size
+        self._items = OrderedDict()
+        self._con = sqlite3.connect(path, check_same_thread=False, factory=TimedConnection)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute("PRAGMA busy_timeout=5000")
+        self._con.execute("""
+        CREATE TABLE IF NOT EXISTS user_state(
+            uid INTEGER PRIMARY KEY,
+            step TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+        self._con.execute("CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state(updated_at)")
+        self._con.commit()
+        self._version = self._data_version()
+
+    def _data_version(self):
+        return self._con.execute("PRAGMA data_version").fetchone()[0]
+
+    def _remember(self, uid, item):
+        self._items[uid] = item
+        self._items.move_to_end(uid)
+        if len(self._items) > self.cache_size:
+            self._items.popitem(last=False)
+
+    def get(self, uid):
+        with self._lock:
+            version = self._data_version()
+            if version != self._version:
+                self._items.clear()
+                self._version = version
+            item = self._items.get(uid)
+            if item is None:
+                row = self._con.execute(
+                    "SELECT step, data, updated_at FROM user_state WHERE uid=?", (uid,)
+                ).fetchone()
+                if row is None:
+                    return None
+                item = (row[0], json.loads(row[1]), row[2])
+            if time.time() - item[2] > self.ttl:
+                self._items.pop(uid, None)
+                return None
+            self._remember(uid, item)
+            return {"step": item[0], "data": dict(item[1])}
+
+    def set(self, uid, step, data):
+        item = (step, dict(data), time.time())
+        with self._lock:
+            with self._con:
+                self._con.execute(
+                    "INSERT INTO user_state(uid, step, data, updated_at) VALUES(?,?,?,?) "
+                    "ON CONFLICT(uid) DO UPDATE SET step=excluded.step, data=excluded.data, "
+                    "updated_at=excluded.updated_at",
+                    (uid, step, json.dumps(item[1], ensure_ascii=False), item[2])
+                )
+            self._remember(uid, item)
+
+    def clear(self, uid):
+        with self._lock:
+            with self._con:
+                self._con.execute("DELETE FROM user_state WHERE uid=?", (uid,))
+            self._items.pop(uid, None)
+
+    def purge(self):
+        with self._lock:
+            with self._con:
+                self._con.execute("DELETE FROM user_state WHERE updated_at < ?", (time.time() - self.ttl,))
+        super().purge()
+
+def state_path():
+    return os.path.splitext(current_tenant().db_path)[0] + ".state.db"
+
+def new_state_store():
+    return SqliteStateStore(state_path()) if STATE_BACKEND == "sqlite" else MemoryStateStore()
+
+state_store = PerTenant(new_state_store)
 
 def set_state(uid, step, data=None):
-    user_state[uid] = {"step": step, "data": data or {}}
+    state_store.set(uid, step, data or {})
 
 def get_state(uid):
-    return user_state.get(uid, {"step": None, "data": {}})
+    return state_store.get(uid) or {"step": None, "data": {}}
 
 def clear_state(uid):
-    if uid in user_state:
-        del user_state[uid]
+    state_store.clear(uid)
+
+def purge_states():
+    state_store.purge()
+
+# --------- ROUTER ----------
+# Әр жаңартуды бір хэш-іздеумен таратамыз: алдымен мәзір батырмасы,
+# сосын ағымдағы қадам (step). Қадамдар мен батырмалар декоратор арқылы кестеге
+# бір рет тіркеледі — ағын қосылған сайын тарату құны өспейді.
+STEP_HANDLERS = {}
+BUTTON_HANDLERS = {}
+CALLBACK_HANDLERS = {}   # callback_data ":" дейінгі префикс бойынша
+
+ROUTER_STATS = {"updates": 0, "dispatch_ns": 0}
+
+def on_step(step):
+    def deco(fn):
+        STEP_HANDLERS[step] = fn
+        return fn
+    return deco
+
+def on_button(text):
+    def deco(fn):
+        BUTTON_HANDLERS[text] = fn
+        return fn
+    return deco
+
+def on_callback(prefix):
+    def deco(fn):
+        CALLBACK_HANDLERS[prefix] = fn
+        return fn
+    return deco
+
+def resolve_message(message):
+    # мәзір батырмасы қадамнан басым: ағын ортасында басылса, ескі қадам тасталады
+    handler = BUTTON_HANDLERS.get(message.text)
+    st = state_store.get(message.from_user.id)
+    if handler is not None:
+        if st is not None:
+            clear_state(message.from_user.id)
+        return handler
+    if st is not None:
+        handler = STEP_HANDLERS.get(st["step"])
+        if handler is not None:
+            return handler
+    return unsupported_message
+
+def router_avg_us():
+    n = ROUTER_STATS["updates"]
+    return ROUTER_STATS["dispatch_ns"] / n / 1000 if n else 0.0
+
+# --------- ТАУАР КЭШІ (id бойынша LRU) ----------
+# ID қадамдары мен қайталанатын сұраулар жадтан жауап алады. Әр өзгерту жолы
+# (қосу, түзету, өшіру, қозғалыс, импорт) pid-ті дәл тазалайды; қалдықты қатаң
+# тексеру бәрібір apply_movement / apply_batch ішінде, БД-да жүреді.
+# TTL — басқа процесс (gunicorn worker) жазған өзгерістің ескіру шегі.
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "2048"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "30"))
+
+Product = namedtuple("Product", "id name qty exp_day min_qty")
+
+class ProductCache:
+    def __init__(self, size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # pid -> (Product, уақыт)
+        self._gen = 0                 # тазалау санағышы: ескі оқу кэшке жазылмайды
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pid):
+        with self._lock:
+            item = self._items.get(pid)
+            if item is not None and time.monotonic() - item[1] <= self.ttl:
+                self._items.move_to_end(pid)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            gen = self._gen
+        row = db().execute(
+            "SELECT id, name, qty, exp_day, min_qty FROM products WHERE id=? AND deleted_at IS NULL", (pid,)
+        ).fetchone()
+        prod = Product(*row) if row else None
+        with self._lock:
+            if prod is None:
+                self._items.pop(pid, None)
+            elif gen == self._gen:
+                self._items[pid] = (prod, time.monotonic())
+                self._items.move_to_end(pid)
+                if len(self._items) > self.size:
+                    self._items.popitem(last=False)
+        return prod
+
+    def discard(self, pid):
+        with self._lock:
+            self._gen += 1
+            self._items.pop(pid, None)
+
+    def clear(self):
+        with self._lock:
+            self._gen += 1
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+product_cache = PerTenant(ProductCache)
+
+@on_stock_change
+def product_cache_drop(pid, name, old_qty, new_qty, old_min, new_min):
+    product_cache.discard(pid)
 
 # --------- HELPERS ----------
 def find_product_by_id(pid: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, qty, exp_date, min_qty FROM products WHERE id=?", (pid,))
-    row = cur.fetchone()
-    con.close()
-    return row
+    return product_cache.get(pid)
 
-def find_products_like(q: str):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, qty, exp_date, min_qty FROM products WHERE name LIKE ? ORDER BY id DESC", (f"%{q}%",))
-    rows = cur.fetchall()
-    con.close()
-    return rows
+# Тауар батырмасы қай қоймада жасалғанын өзімен алып жүреді: "<prefix>:<tenant_id>:<pid>".
+# Қолданушы қойма ауыстырса, ескі хабарламадағы батырма басқа қойманың тауарына тимейді.
+def product_cb(prefix, pid):
+    return f"{prefix}:{current_tenant().id}:{pid}"
+
+def product_from_cb(call):
+    parts = call.data.split(":")
+    if len(parts) != 3 or int(parts[1]) != current_tenant().id:
+        bot.answer_callback_query(call.id, "⚠️ Бұл батырма басқа қоймаға тиесілі. Қайта бастаңыз.", show_alert=True)
+        return None
+    return int(parts[2])
 
-def list_products(limit=50):
+SQL_IN_CHUNK = 500  # бір IN (...) сұрауындағы параметр саны
+
+def products_by_ids(pids):
+    con = db()
+    out = {}
+    for i in range(0, len(pids), SQL_IN_CHUNK):
+        chunk = pids[i:i + SQL_IN_CHUNK]
+        marks = ",".join("?" * len(chunk))
+        for row in con.execute(
+            f"SELECT id, name, qty, exp_day, min_qty FROM products WHERE id IN ({marks}) AND deleted_at IS NULL", chunk
+        ):
+            out[row[0]] = row
+    return out
+
+# Тірі тауарлар атауы бойынша (импорт upsert-і); атау қайталанса — ең жаңасы
+def products_by_names(names):
     con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, qty, exp_date, min_qty FROM products ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    con.close()
-    return rows
+    out = {}
+    names = list(set(names))
+    for i in range(0, len(names), SQL_IN_CHUNK):
+        chunk = names[i:i + SQL_IN_CHUNK]
+        marks = ",".join("?" * len(chunk))
+        for row in con.execute(
+            f"SELECT id, name, qty, exp_day, min_qty FROM products "
+            f"WHERE name IN ({marks}) AND deleted_at IS NULL ORDER BY id", chunk
+        ):
+            out[row[1]] = row
+    return out
+
+def find_products_like(q: str, limit: int = SEARCH_LIMIT):
+    fq = fold_text(q)
+    # trigram индексі кемінде 3 таңбалы сұрауға ғана жарайды
+    if FTS_ENABLED and len(fq) >= 3:
+        return db().execute("""
+        SELECT p.id, p.name, p.qty, p.exp_day, p.min_qty
+        FROM products_fts f
+        JOIN products p ON p.id = f.rowid
+        WHERE products_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ?
+        """, ('"' + fq.replace('"', '""') + '"', limit)).fetchall()
+    # қысқа сұрау (Ұн, Ет, Май): бүктелген атау бойынша id ретімен сканерлеу,
+    # LIMIT толғанда тоқтайды. LIKE кирилл регистрін бүктемейді — fold_text Python-да.
+    return db().execute(
+        "SELECT id, name, qty, exp_day, min_qty FROM products "
+        "WHERE deleted_at IS NULL AND instr(fold_text(name), ?) > 0 ORDER BY id DESC LIMIT ?",
+        (fq, limit)
+    ).fetchall()
+
+PAGE_SIZE = 20
+PRODUCT_LINE_MAX = 190     # PAGE_SIZE жол бір хабарламаға сыюы үшін
+
+# Keyset пагинация: OFFSET жоқ, әр бет — PRIMARY KEY бойынша бір диапазон оқу.
+# direction="next" — cursor-дан ескірек (id < cursor), "prev" — жаңарақ (id > cursor).
+# (rows, has_prev, has_next) қайтарады; rows әрқашан id DESC ретімен.
+def list_products(cursor=None, direction="next", limit=PAGE_SIZE):
+    con = db()
+    if direction == "prev":
+        rows = con.execute(
+            "SELECT id, name, qty, exp_day, min_qty FROM products WHERE id > ? AND deleted_at IS NULL "
+            "ORDER BY id ASC LIMIT ?",
+            (cursor, limit + 1)
+        ).fetchall()
+        more = len(rows) > limit
+        return rows[:limit][::-1], more, True
+
+    if cursor is None:
+        rows = con.execute(
+            "SELECT id, name, qty, exp_day, min_qty FROM products WHERE deleted_at IS NULL "
+            "ORDER BY id DESC LIMIT ?", (limit + 1,)
+        ).fetchall()
+    else:
+        rows = con.execute(
+            "SELECT id, name, qty, exp_day, min_qty FROM products WHERE id < ? AND deleted_at IS NULL "
+            "ORDER BY id DESC LIMIT ?",
+            (cursor, limit + 1)
+        ).fetchall()
+    return rows[:limit], cursor is not None, len(rows) > limit
+
+# Журнал/экспортта тауар атауы; өшірілгені "(өшірілген ID:n)" белгісімен
+PRODUCT_LABEL_SQL = (
+    "CASE WHEN p.deleted_at IS NULL THEN p.name "
+    "ELSE trim(p.name || ' (өшірілген ID:' || p.id || ')') END"
+)
+
+def product_line(row):
+    pid, name, qty, exp, minq = row
+    head, tail = f"ID:{pid} | ", f" — {qty} дана — {fmt_day(exp) or '—'} | min:{minq}"
+    # ұзын атауды қысқартамыз — саны мен мерзімі көрініп тұруы керек
+    room = PRODUCT_LINE_MAX - len(head) - len(tail)
+    if len(name) > room:
+        name = name[:room - 1] + "…"
+    return head + name + tail + "\n"
 
 def text_products(rows):
     if not rows:
         return "Қойма бос."
-    t = "Қоймадағы тауарлар:\n\n"
-    for pid, name, qty, exp, minq in rows:
-        exp_show = exp if exp else "—"
-        t += f"ID:{pid} | {name} — {qty} дана — {exp_show} | min:{minq}\n"
-    return t
+    return "Қоймадағы тауарлар:\n\n" + "".join(map(product_line, rows))
+
+# --------- ҰЗЫН ЕСЕПТЕРДІ БӨЛІП ЖІБЕРУ ----------
+# Telegram шегі 4096 (UTF-16 бірлігімен) — эмодзиге қор қалдырамыз
+MESSAGE_CHUNK = 4000
+
+# lines — генератор (көбіне курсордан). Буфер бір хабарламадан аспайды;
+# толған сайын жіберіледі, клавиатура тек соңғы бөлікке қойылады.
+def send_chunked(chat_id, lines, header="", empty_text="", footer="", reply_markup=None):
+    buf, size = [header], len(header)
+    held = None   # соңғысы екенін білгенше бір бөлікті ұстап тұрамыз
+    got = False
+    for line in lines:
+        got = True
+        line = line[:MESSAGE_CHUNK]
+        if size + len(line) > MESSAGE_CHUNK:
+            if held is not None:
+                bot.send_message(chat_id, held)
+            held = "".join(buf)
+            buf, size = [], 0
+        buf.append(line)
+        size += len(line)
+
+    if not got:
+        bot.send_message(chat_id, empty_text, reply_markup=reply_markup)
+        return
+    if footer:
+        if size + len(footer) > MESSAGE_CHUNK:
+            if held is not None:
+                bot.send_message(chat_id, held)
+            held = "".join(buf)
+            buf = []
+        buf.append(footer)
+    if held is not None:
+        bot.send_message(chat_id, held)
+    bot.send_message(chat_id, "".join(buf), reply_markup=reply_markup)
 
 @bot.message_handler(commands=["start"])
 def start(message):
     uid = message.from_user.id
 
-    if uid not in ALLOWED_USERS:
-        bot.send_message(
-            message.chat.id,
-            "⛔ Бұл ботқа қол жеткізу шектеулі.\n"
-            "Қойма есебі тек уәкілетті пайдаланушыларға арналған."
-        )
+    if not is_allowed(uid):
+        bot.send_message(message.chat.id, ACCESS_DENIED_TEXT)
         return
 
-    init_db()
     bot.send_message(
         message.chat.id,
         "✅ Қойма есебі жүйесіне қош келдіңіз!",
@@ -152,20 +1962,24 @@ def start(message):
 # =========================================================
 # 1) ТАУАР ҚОСУ (сенде бар болса — қалдыруға болады)
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "➕ Тауар қосу")
+@on_button("➕ Тауар қосу")
 def add_product_start(message):
     set_state(message.from_user.id, "ADD_NAME")
-    bot.send_message(message.chat.id, "Тауар атауын енгізіңіз:")
+    bot.send_message(
+        message.chat.id,
+        "Тауар атауын енгізіңіз:\n"
+        "(Көп тауар болса — CSV/XLSX файл жіберіңіз: name, qty, exp_date, min_qty;\n"
+        "атауы бар тауарға саны қосылады, жаңасы қосылады)"
+    )
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.
-id)["step"] == "ADD_NAME")
+@on_step("ADD_NAME")
 def add_product_name(message):
     st = get_state(message.from_user.id)
     st["data"]["name"] = message.text.strip()
     set_state(message.from_user.id, "ADD_QTY", st["data"])
     bot.send_message(message.chat.id, "Санын енгізіңіз (мысалы: 10):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "ADD_QTY")
+@on_step("ADD_QTY")
 def add_product_qty(message):
     try:
         qty = int(message.text.strip())
@@ -180,7 +1994,7 @@ def add_product_qty(message):
     set_state(message.from_user.id, "ADD_EXP", st["data"])
     bot.send_message(message.chat.id, "Мерзімі (YYYY-MM-DD) немесе '-' деп жіберіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "ADD_EXP")
+@on_step("ADD_EXP")
 def add_product_exp(message):
     exp = message.text.strip()
     if exp == "-":
@@ -188,17 +2002,17 @@ def add_product_exp(message):
     else:
         # жеңіл тексеріс
         try:
-            datetime.strptime(exp, "%Y-%m-%d")
+            exp = parse_day(exp)
         except:
             bot.send_message(message.chat.id, "⚠️ Дата форматы қате. Мысалы: 2026-02-17 немесе '-'")
             return
 
     st = get_state(message.from_user.id)
-    st["data"]["exp_date"] = exp
+    st["data"]["exp_day"] = exp
     set_state(message.from_user.id, "ADD_MIN", st["data"])
     bot.send_message(message.chat.id, "Min саны (аз қалды ескерту үшін). Мысалы 5. Егер керек болмаса 0:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "ADD_MIN")
+@on_step("ADD_MIN")
 def add_product_min(message):
     try:
         minq = int(message.text.strip())
@@ -209,13 +2023,18 @@ def add_product_min(message):
         return
 
     st = get_state(message.from_user.id)["data"]
-    name, qty, exp = st["name"], st["qty"], st["exp_date"]
+    name, qty, exp = st["name"], st["qty"], st["exp_day"]
 
     con = db()
-    cur = con.cursor()
-    cur.execute("INSERT INTO products(name, qty, exp_date, min_qty) VALUES(?,?,?,?)", (name, qty, exp, minq))
-    con.commit()
-    con.close()
+    with con:
+        cur = con.execute("INSERT INTO products(name, qty, exp_day, min_qty) VALUES(?,?,?,?)", (name, qty, exp, minq))
+        # бастапқы қалдық та журналда — күндегі қалдық қозғалыстардан қалпына келеді
+        if qty:
+            con.execute(
+                "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)",
+                (cur.lastrowid, "IN", qty, now_ts(), "Бастапқы қалдық")
+            )
+    exp_calendar.set(cur.lastrowid, exp)
 
     clear_state(message.from_user.id)
     bot.send_message(message.chat.id, f"✅ Қосылды: {name} — {qty} дана | min:{minq}", reply_markup=main_kb())
@@ -223,20 +2042,48 @@ def add_product_min(message):
 # =========================================================
 # 2) ҚОЙМА ТІЗІМІ
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "📦 Қойма тізімі")
+def list_page_kb(rows, has_prev, has_next):
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton("◀️ Алдыңғы", callback_data=f"lst:p:{rows[0][0]}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton("Келесі ▶️", callback_data=f"lst:n:{rows[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    return kb
+
+@on_button("📦 Қойма тізімі")
 def show_list(message):
-    rows = list_products(100)
-    bot.send_message(message.chat.id, text_products(rows), reply_markup=main_kb())
+    rows, has_prev, has_next = list_products()
+    bot.send_message(message.chat.id, text_products(rows), reply_markup=list_page_kb(rows, has_prev, has_next))
+
+@on_callback("lst")
+def list_page_cb(call):
+    _, direction, cursor = call.data.split(":")
+    rows, has_prev, has_next = list_products(int(cursor), "prev" if direction == "p" else "next")
+    if not rows:
+        # шеттегі тауарлар өшірілген болса — басынан көрсетеміз
+        rows, has_prev, has_next = list_products()
+    bot.answer_callback_query(call.id)
+    try:
+        bot.edit_message_text(
+            text_products(rows), call.message.chat.id, call.message.message_id,
+            reply_markup=list_page_kb(rows, has_prev, has_next)
+        )
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            raise
 
 # =========================================================
 # 3) ТАУАР ӨШІРУ
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "❌ Тауар өшіру")
+@on_button("❌ Тауар өшіру")
 def delete_start(message):
     set_state(message.from_user.id, "DEL_ID")
     bot.send_message(message.chat.id, "Өшіретін тауар ID енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "DEL_ID")
+@on_step("DEL_ID")
 def delete_by_id(message):
     try:
         pid = int(message.text.strip())
@@ -253,70 +2100,70 @@ def delete_by_id(message):
     # растау
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("✅ Иә, өшірем", callback_data=f"del_yes:{pid}"),
+        types.InlineKeyboardButton("✅ Иә, өшірем", callback_data=product_cb("del_yes", pid)),
         types.InlineKeyboardButton("❌ Жоқ", callback_data="del_no")
     )
     bot.send_message(message.chat.id, f"Өшіру керек пе?\nID:{prod[0]} | {prod[1]}", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("del_yes:"))
+@on_callback("del_yes")
 def del_yes(call):
-    pid = int(call.data.split(":")[1])
+    pid = product_from_cb(call)
+    if pid is None:
+        return
     con = db()
-    cur = con.cursor()
-    cur.execute("DELETE FROM products WHERE id=?", (pid,))
-    con.commit()
-    con.close()
+    with con:
+        # жол қалады: журнал мен күндегі қалдық тауардың id-і мен соңғы қалдығын көреді
+        con.execute("UPDATE products SET deleted_at=? WHERE id=? AND deleted_at IS NULL", (now_ts(), pid))
+    exp_calendar.discard(pid)
+    product_cache.discard(pid)
     bot.answer_callback_query(call.id, "Өшірілді ✅")
     bot.send_message(call.message.chat.id, "✅ Тауар өшірілді.", reply_markup=main_kb())
     clear_state(call.
 from_user.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "del_no")
+@on_callback("del_no")
 def del_no(call):
     bot.answer_callback_query(call.id, "Болды")
     bot.send_message(call.message.chat.id, "Өшіру тоқтатылды.", reply_markup=main_kb())
     clear_state(call.from_user.id)
 
 # =========================================================
-# 4) МЕРЗІМ ТЕКСЕРУ (30 күн ішінде бітетіндер)
+# 4) МЕРЗІМ ТЕКСЕРУ (EXP_HORIZON_DAYS ішінде бітетіндер)
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "⏰ Мерзім тексеру")
+@on_button("⏰ Мерзім тексеру")
 def check_exp(message):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, qty, exp_date FROM products WHERE exp_date IS NOT NULL")
-    rows = cur.fetchall()
-    con.close()
-
-    today = date.today()
-    near = []
-    for pid, name, qty, exp in rows:
-        try:
-            d = datetime.strptime(exp, "%Y-%m-%d").date()
-            days = (d - today).days
-            if days <= 30:
-                near.append((pid, name, qty, exp, days))
-        except:
-            pass
-
+    exp_calendar.sync()
+    near = exp_calendar.within(EXP_HORIZON_DAYS)
     if not near:
-        bot.send_message(message.chat.id, "✅ 30 күн ішінде мерзімі бітетін тауар жоқ.")
+        bot.send_message(message.chat.id, f"✅ {EXP_HORIZON_DAYS} күн ішінде мерзімі бітетін тауар жоқ.")
         return
 
-    text = "⏰ Мерзімі жақын тауарлар (30 күн):\n\n"
-    for pid, name, qty, exp, days in sorted(near, key=lambda x: x[4]):
-        text += f"ID:{pid} | {name} — {qty} дана — {exp} (қалды {days} күн)\n"
-    bot.send_message(message.chat.id, text)
+    send_chunked(
+        message.chat.id, expiry_lines(near),
+        header=f"⏰ Мерзімі жақын тауарлар ({EXP_HORIZON_DAYS} күн):\n\n",
+        empty_text=f"✅ {EXP_HORIZON_DAYS} күн ішінде мерзімі бітетін тауар жоқ.",
+        reply_markup=main_kb()
+    )
+
+def expiry_lines(near):
+    today = date.today().toordinal()
+    for i in range(0, len(near), SQL_IN_CHUNK):
+        part = near[i:i + SQL_IN_CHUNK]
+        rows = products_by_ids([pid for _, pid in part])
+        for exp, pid in part:
+            prod = rows.get(pid)
+            if prod:
+                yield f"ID:{pid} | {prod[1]} — {prod[2]} дана — {fmt_day(exp)} (қалды {exp - today} күн)\n"
 
 # =========================================================
 # 5) САТУ ТІРКЕУ (OUT)
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "➖ Сату тіркеу")
+@on_button("➖ Сату тіркеу")
 def sale_start(message):
     set_state(message.from_user.id, "OUT_ID")
     bot.send_message(message.chat.id, "Сатылатын тауар ID енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "OUT_ID")
+@on_step("OUT_ID")
 def sale_id(message):
     try:
         pid = int(message.text.strip())
@@ -333,7 +2180,7 @@ def sale_id(message):
     set_state(message.from_user.id, "OUT_QTY", {"pid": pid})
     bot.send_message(message.chat.id, f"{prod[1]} сатылатын санын енгізіңіз (қалдық: {prod[2]}):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "OUT_QTY")
+@on_step("OUT_QTY")
 def sale_qty(message):
     st = get_state(message.from_user.id)["data"]
     pid = st["pid"]
@@ -346,59 +2193,61 @@ def sale_qty(message):
         bot.send_message(message.chat.id, "⚠️ Сан қате. Мысалы: 2")
         return
 
-    prod = find_product_by_id(pid)
-    if not prod:
-        bot.send_message(message.chat.id, "❌ Тауар табылмады.")
-        clear_state(message.from_user.id)
-        return
-
-    if qty > prod[2]:
+    res = apply_movement(pid, "OUT", qty, "Сату")
+    if res is None:
+        prod = find_product_by_id(pid)
+        if not prod:
+            bot.send_message(message.chat.id, "❌ Тауар табылмады.")
+            clear_state(message.from_user.id)
+            return
         bot.send_message(message.chat.id, f"⚠️ Қалдық жетпейді. Қоймада {prod[2]} ғана бар.")
         return
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET qty = qty - ? WHERE id=?", (qty, pid))
-    con.commit()
-    con.close()
-
-    log_movement(pid, "OUT", qty, "Сату")
     clear_state(message.from_user.id)
-    bot.send_message(message.chat.id, f"✅ Сатылды: {prod[1]} — {qty} дана", reply_markup=main_kb())
+    bot.send_message(message.chat.id, f"✅ Сатылды: {res[0]} — {qty} дана", reply_markup=main_kb())
 
 # =========================================================
-# 6) СТАТИСТИКА (қарапайым)
+# 6) СТАТИСТИКА (stats_totals / stats_daily жинақтарынан)
 # =========================================================
-@bot.message_handler(func=lambda m: m.text == "📊 Статистика")
-def stats(message):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(qty),0) FROM products")
-    total_products, total_qty = cur.fetchone()
+STATS_PERIODS = (("Бүгін", 0), ("7 күн", 6), ("30 күн", 29))
 
-    cur.execute("SELECT COUNT(*) FROM movements")
-    moves = cur.fetchone()[0]
+def period_line(title, totals):
+    parts = []
+    for mtype, label, sign in (("IN", "кіріс", "+"), ("OUT", "сату", "−"), ("WRITE_OFF", "списание", "−")):
+        moves, qty = totals.get(mtype, (0, 0))
+        parts.append(f"{label} {sign}{qty} ({moves})")
+    return f"• {title}: " + " | ".join(parts)
 
-    con.close()
-    bot.send_message(
-        message.chat.id,
-        f"📊 Статистика:\n"
-        f"• Тауар түрі: {total_products}\n"
-        f"• Жалпы саны: {total_qty}\n"
-        f"• Операциялар (журнал): {moves}"
-    )
+@on_button("📊 Статистика")
+def stats(message):
+    total_products, total_qty, moves = db().execute(
+        "SELECT product_count, total_qty, movement_count FROM stats_totals WHERE id = 1"
+    ).fetchone()
+    lines = [
+        "📊 Статистика:",
+        f"• Тауар түрі: {total_products}",
+        f"• Жалпы саны: {total_qty}",
+        f"• Операциялар (журнал): {moves}",
+        "",
+    ]
+    today = date.today()
+    for title, back in STATS_PERIODS:
+        lines.append(period_line(title, period_totals((today - timedelta(days=back)).toordinal())))
+    if message.from_user.id in ADMIN_IDS:
+        lines.append(f"\n• Router: {ROUTER_STATS['updates']} жаңарту, орташа {router_avg_us():.1f} µs")
+    bot.send_message(message.chat.id, "\n".join(lines))
 
 # =========================================================
 # ===================== ЖАҢА ФУНКЦИЯЛАР =====================
 # =========================================================
 
 # 7) КІРІС ТІРКЕУ (IN)
-@bot.message_handler(func=lambda m: m.text == "➕ Кіріс тіркеу")
+@on_button("➕ Кіріс тіркеу")
 def income_start(message):
     set_state(message.from_user.id, "IN_ID")
     bot.send_message(message.chat.id, "Кіріс болатын тауар ID енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "IN_ID")
+@on_step("IN_ID")
 def income_id(message):
     try:
         pid = int(message.text.strip())
@@ -415,7 +2264,7 @@ def income_id(message):
     set_state(message.from_user.id, "IN_QTY", {"pid": pid})
     bot.send_message(message.chat.id, f"{prod[1]} кіріс санын енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "IN_QTY")
+@on_step("IN_QTY")
 def income_qty(message):
     st = get_state(message.from_user.id)["data"]
     pid = st["pid"]
@@ -428,29 +2277,22 @@ def income_qty(message):
         bot.send_message(message.chat.id, "⚠️ Сан қате. Мысалы: 20")
         return
 
-    prod = find_product_by_id(pid)
-    if not prod:
+    res = apply_movement(pid, "IN", qty, "Кіріс")
+    if res is None:
         bot.send_message(message.chat.id, "❌ Тауар табылмады.")
         clear_state(message.from_user.id)
         return
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET qty = qty + ? WHERE id=?", (qty, pid))
-    con.commit()
-    con.close()
-
-    log_movement(pid, "IN", qty, "Кіріс")
     clear_state(message.from_user.id)
-    bot.send_message(message.chat.id, f"✅ Кіріс тіркелді: {prod[1]} — +{qty} дана", reply_markup=main_kb())
+    bot.send_message(message.chat.id, f"✅ Кіріс тіркелді: {res[0]} — +{qty} дана", reply_markup=main_kb())
 
 # 8) СПИСАНИЕ (WRITE_OFF)
-@bot.message_handler(func=lambda m: m.text == "🗑️ Списание")
+@on_button("🗑️ Списание")
 def writeoff_start(message):
     set_state(message.from_user.id, "WO_ID")
     bot.send_message(message.chat.id, "Списание болатын тауар ID енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "WO_ID")
+@on_step("WO_ID")
 def writeoff_id(message):
     try:
         pid = int(message.text.strip())
@@ -467,7 +2309,7 @@ def writeoff_id(message):
     set_state(message.from_user.id, "WO_QTY", {"pid": pid})
     bot.send_message(message.chat.id, f"{prod[1]} списание санын енгізіңіз (қалдық: {prod[2]}):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "WO_QTY")
+@on_step("WO_QTY")
 def writeoff_qty(message):
     st = get_state(message.from_user.id)["data"]
     pid = st["pid"]
@@ -493,54 +2335,55 @@ def writeoff_qty(message):
     set_state(message.from_user.id, "WO_REASON", {"pid": pid, "qty": qty})
     bot.send_message(message.chat.id, "Себебін жазыңыз (мыс: бұзылды/мерзімі өтті):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "WO_REASON")
+@on_step("WO_REASON")
 def writeoff_reason(message):
     st = get_state(message.from_user.id)["data"]
     pid = st["pid"]
     qty = st["qty"]
     reason = message.text.strip()
 
-    prod = find_product_by_id(pid)
-    if not prod:
-        bot.send_message(message.chat.id, "❌ Тауар табылмады.")
-        clear_state(message.from_user.id)
-        return
-
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET qty = qty - ? WHERE id = ?", (qty, pid))
-    con.commit()
-    con.close()
-
-    log_movement(pid, "WRITE_OFF", qty, reason)
+    res = apply_movement(pid, "WRITE_OFF", qty, reason)
     clear_state(message.from_user.id)
+    if res is None:
+        prod = find_product_by_id(pid)
+        if not prod:
+            bot.send_message(message.chat.id, "❌ Тауар табылмады.", reply_markup=main_kb())
+        else:
+            bot.send_message(message.chat.id, f"⚠️ Қалдық жетпейді. Қоймада {prod[2]} ғана бар.", reply_markup=main_kb())
+        return
 
     bot.send_message(
         message.chat.id,
-        f"✅ Списание: {prod[1]} — {qty} дана\nСебеп: {reason}",
+        f"✅ Списание: {res[0]} — {qty} дана\nСебеп: {reason}",
         reply_markup=main_kb()
     )
 
 # 9) ІЗДЕУ 🔎 (атау бойынша)
-@bot.message_handler(func=lambda m: m.text == "🔎 Іздеу")
+@on_button("🔎 Іздеу")
 def search_start(message):
     set_state(message.from_user.id, "SEARCH_Q")
     bot.send_message(message.chat.id, "Іздеу сөзін енгізіңіз (мыс: пепси):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "SEARCH_Q")
+@on_step("SEARCH_Q")
 def search_query(message):
     q = message.text.strip()
     rows = find_products_like(q)
     clear_state(message.from_user.id)
-    bot.send_message(message.chat.id, "🔎 Нәтиже:\n\n" + text_products(rows), reply_markup=main_kb())
+    send_chunked(
+        message.chat.id, map(product_line, rows),
+        header="🔎 Нәтиже:\n\n",
+        empty_text="🔎 Ештеңе табылмады.",
+        footer=f"\nАлғашқы {SEARCH_LIMIT} нәтиже көрсетілді — сұрауды нақтылаңыз." if len(rows) >= SEARCH_LIMIT else "",
+        reply_markup=main_kb()
+    )
 
 # 10) ТАУАР ӨҢДЕУ ✏️ (атау/мерзім/min)
-@bot.message_handler(func=lambda m: m.text == "✏️ Тауар өңдеу")
+@on_button("✏️ Тауар өңдеу")
 def edit_start(message):
     set_state(message.from_user.id, "EDIT_ID")
     bot.send_message(message.chat.id, "Өңдейтін тауар ID енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "EDIT_ID")
+@on_step("EDIT_ID")
 def edit_id(message):
     try:
         pid = int(message.text.strip())
@@ -557,41 +2400,44 @@ def edit_id(message):
     set_state(message.from_user.id, "EDIT_MENU", {"pid": pid})
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("📝 Атауын өзгерту", callback_data=f"edit_name:{pid}"),
-        types.InlineKeyboardButton("⏰ Мерзімін өзгерту", callback_data=f"edit_exp:{pid}"),
-        types.InlineKeyboardButton("⚠️ Min санын өзгерту", callback_data=f"edit_min:{pid}"),
+        types.InlineKeyboardButton("📝 Атауын өзгерту", callback_data=product_cb("edit_name", pid)),
+        types.InlineKeyboardButton("⏰ Мерзімін өзгерту", callback_data=product_cb("edit_exp", pid)),
+        types.InlineKeyboardButton("⚠️ Min санын өзгерту", callback_data=product_cb("edit_min", pid)),
     )
     bot.send_message(message.chat.id, f"Таңдаңыз:\nID:{prod[0]} | {prod[1]}", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_name:"))
+@on_callback("edit_name")
 def edit_name_cb(call):
-    pid = int(call.data.split(":")[1])
+    pid = product_from_cb(call)
+    if pid is None:
+        return
     set_state(call.from_user.id, "EDIT_NAME", {"pid": pid})
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Жаңа атауын енгізіңіз:")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "EDIT_NAME")
+@on_step("EDIT_NAME")
 def edit_name_save(message):
     pid = get_state(message.from_user.id)["data"]["pid"]
     new_name = message.text.strip()
 
     con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET name=? WHERE id=?", (new_name, pid))
-    con.commit()
-    con.close()
+    with con:
+        con.execute("UPDATE products SET name=? WHERE id=? AND deleted_at IS NULL", (new_name, pid))
+    product_cache.discard(pid)
 
     clear_state(message.from_user.id)
     bot.send_message(message.chat.id, "✅ Атауы жаңартылды.", reply_markup=main_kb())
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_exp:"))
+@on_callback("edit_exp")
 def edit_exp_cb(call):
-    pid = int(call.data.split(":")[1])
+    pid = product_from_cb(call)
+    if pid is None:
+        return
     set_state(call.from_user.id, "EDIT_EXP", {"pid": pid})
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Жаңа мерзім (YYYY-MM-DD) немесе '-' :")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "EDIT_EXP")
+@on_step("EDIT_EXP")
 def edit_exp_save(message):
     pid = get_state(message.from_user.id)["data"]["pid"]
     exp = message.text.strip()
@@ -599,28 +2445,30 @@ def edit_exp_save(message):
         exp = None
     else:
         try:
-            datetime.strptime(exp, "%Y-%m-%d")
+            exp = parse_day(exp)
         except:
             bot.send_message(message.chat.id, "⚠️ Формат қате. Мысалы: 2026-03-24 немесе '-'")
             return
 
     con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET exp_date=? WHERE id=?", (exp, pid))
-    con.commit()
-    con.close()
+    with con:
+        con.execute("UPDATE products SET exp_day=? WHERE id=? AND deleted_at IS NULL", (exp, pid))
+    exp_calendar.set(pid, exp)
+    product_cache.discard(pid)
 
     clear_state(message.from_user.id)
     bot.send_message(message.chat.id, "✅ Мерзім жаңартылды.", reply_markup=main_kb())
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_min:"))
+@on_callback("edit_min")
 def edit_min_cb(call):
-    pid = int(call.data.split(":")[1])
+    pid = product_from_cb(call)
+    if pid is None:
+        return
     set_state(call.from_user.id, "EDIT_MIN", {"pid": pid})
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Жаңа min саны (мыс: 5 немесе 0):")
 
-@bot.message_handler(func=lambda m: get_state(m.from_user.id)["step"] == "EDIT_MIN")
+@on_step("EDIT_MIN")
 def edit_min_save(message):
     pid = get_state(message.from_user.id)["data"]["pid"]
     try:
@@ -632,63 +2480,732 @@ def edit_min_save(message):
         return
 
     con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE products SET min_qty=? WHERE id=?", (minq, pid))
-    con.commit()
-    con.close()
+    with con:
+        prod = con.execute("SELECT name, qty, min_qty FROM products WHERE id=? AND deleted_at IS NULL", (pid,)).fetchone()
+        con.execute("UPDATE products SET min_qty=? WHERE id=? AND deleted_at IS NULL", (minq, pid))
 
     clear_state(message.from_user.id)
     bot.send_message(message.chat.id, "✅ Min саны жаңартылды.", reply_markup=main_kb())
+    if prod:
+        stock_changed(pid, prod[0], prod[1], prod[1], prod[2], minq)
 
 # 11) АЗ ҚАЛДЫ ⚠️
-@bot.message_handler(func=lambda m: m.text == "⚠️ Аз қалды")
+@on_button("⚠️ Аз қалды")
 def low_stock(message):
+    cur = db().execute(LOW_STOCK_SQL)
+    send_chunked(
+        message.chat.id,
+        (f"ID:{pid} | {name} — {qty} дана (min:{minq})\n" for pid, name, qty, minq in cur),
+        header="⚠️ Аз қалған тауарлар:\n\n",
+        empty_text="✅ Аз қалған тауар жоқ (немесе min қойылмаған).",
+        reply_markup=main_kb()
+    )
+
+def journal_line(row):
+    mid, pname, mtype, qty, created_at, comment = row
+    line = f"#{mid} | {mtype} | {pname} | {qty} дана | {fmt_ts(created_at)}"
+    line = f"{line} | {comment}" if comment else line
+    return line[:JOURNAL_LINE_MAX] + "\n"
+
+# "/journal 12 OUT 2026-09-01 2026-09-30 gz" сияқты аргументтер (бәрі міндетті емес):
+# бүтін сан — тауар ID, IN/OUT/WRITE_OFF — түрі, күндер — аралық, gz — тек экспортқа.
+def parse_filter_args(text: str):
+    args = {"pid": None, "from": None, "to": None, "mtype": None, "gz": False}
+    for tok in text.split()[1:]:
+        up = tok.upper()
+        if up in MOVEMENT_SIGN:
+            args["mtype"] = up
+        elif tok.lower() in ("gz", "gzip"):
+            args["gz"] = True
+        elif tok.isdigit():
+            args["pid"] = int(tok)
+        else:
+            d = date.fromisoformat(tok)
+            args["from" if args["from"] is None else "to"] = d
+    return args
+
+# 12) ЖУРНАЛ 🧾 (сүзгі + keyset пагинация)
+# Индекстер: (product_id, id), (mtype, id), (created_at epoch). Күн аралығы алдымен
+# created_at индексі арқылы id шекарасына айналады (id уақытпен бірге өседі),
+# сосын әр бет — тиісті индекс бойынша бір id диапазонын оқу.
+JOURNAL_PAGE = 20
+JOURNAL_LINE_MAX = 190     # бет бір хабарламаға сыюы үшін
+JOURNAL_TYPE_CODES = {"IN": "I", "OUT": "O", "WRITE_OFF": "W"}
+JOURNAL_CODE_TYPES = {v: k for k, v in JOURNAL_TYPE_CODES.items()}
+MAX_ID = 2 ** 63 - 1
+
+# [lo, hi] id аралығы кестелерге бөлінеді (id өсу ретімен): id <= archive_state.upto —
+# archive.movements, қалғаны негізгі базада. Әр бөлік өз индексімен бөлек оқылады.
+def movement_parts(con, lo=0, hi=MAX_ID):
+    upto = archived_upto(con)
+    parts = []
+    if upto and lo <= upto:
+        attach_archive(con)
+        parts.append(("archive.movements", lo, min(hi, upto)))
+    if hi > upto:
+        parts.append(("main.movements", max(lo, upto + 1), hi))
+    return parts
+
+def journal_bounds(d_from, d_to):
+    con = db()
+    lo, hi = 0, MAX_ID
+    if d_from:
+        lo = MAX_ID
+        for table, a, b in movement_parts(con):
+            row = con.execute(
+                f"SELECT id FROM {table} WHERE created_at >= ? AND id BETWEEN ? AND ? "
+                "ORDER BY created_at, id LIMIT 1",
+                (day_start_ts(d_from), a, b)
+            ).fetchone()
+            if row:
+                lo = row[0]
+                break
+    if d_to:
+        hi = 0
+        for table, a, b in reversed(movement_parts(con)):
+            row = con.execute(
+                f"SELECT id FROM {table} WHERE created_at < ? AND id BETWEEN ? AND ? "
+                "ORDER BY created_at DESC, id DESC LIMIT 1",
+                (day_start_ts(d_to + timedelta(days=1)), a, b)
+            ).fetchone()
+            if row:
+                hi = row[0]
+                break
+    return lo, hi
+
+def journal_page(f, cursor=None, direction="next", limit=JOURNAL_PAGE):
     con = db()
-    cur = con.cursor()
-    cur.execute("SELECT id, name, qty, min_qty FROM products WHERE qty <= min_qty AND min_qty > 0 ORDER BY qty ASC")
-    rows = cur.fetchall()
-    con.close()
+    lo, hi = journal_bounds(f["from"], f["to"])
+    where, params = ["m.id BETWEEN ? AND ?"], []
+    if f["pid"]:
+        where.append("m.product_id = ?")
+        params.append(f["pid"])
+    if f["mtype"]:
+        where.append("m.mtype = ?")
+        params.append(f["mtype"])
+    if cursor is not None:
+        where.append("m.id > ?" if direction == "prev" else "m.id < ?")
+        params.append(cursor)
+    parts = movement_parts(con, lo, hi)
+    if direction != "prev":
+        parts.reverse()
+    rows = []
+    for table, a, b in parts:
+        rows += con.execute(f"""
+        SELECT m.id, {PRODUCT_LABEL_SQL}, m.mtype, m.qty, m.created_at, m.comment
+        FROM {table} m
+        LEFT JOIN products p ON p.id = m.product_id
+        WHERE {" AND ".join(where)}
+        ORDER BY m.id {"ASC" if direction == "prev" else "DESC"}
+        LIMIT ?
+        """, [a, b] + params + [limit + 1 - len(rows)]).fetchall()
+        if len(rows) > limit:
+            break
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        return rows[::-1], more, True
+    return rows, cursor is not None, more
+
+def journal_title(f):
+    parts = []
+    if f["pid"]:
+        parts.append(f"ID:{f['pid']}")
+    if f["mtype"]:
+        parts.append(f["mtype"])
+    if f["from"] or f["to"]:
+        parts.append(f"{f['from'] or '…'} — {f['to'] or '…'}")
+    return "🧾 Журнал" + (f" ({', '.join(parts)})" if parts else "") + ":\n\n"
+
+def journal_text(f, rows):
+    if not rows:
+        return journal_title(f) + "Операция жоқ."
+    return journal_title(f) + "".join(map(journal_line, rows))
+
+def journal_kb(f, rows, has_prev, has_next):
+    # jr:<n|p>:<cursor>:<pid>:<type>:<from>:<to> — 64 байттан аспайды
+    tail = ":".join((
+        str(f["pid"] or ""),
+        JOURNAL_TYPE_CODES.get(f["mtype"], ""),
+        f["from"].strftime("%Y%m%d") if f["from"] else "",
+        f["to"].strftime("%Y%m%d") if f["to"] else "",
+    ))
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton("◀️ Жаңарақ", callback_data=f"jr:p:{rows[0][0]}:{tail}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton("Ескірек ▶️", callback_data=f"jr:n:{rows[-1][0]}:{tail}"))
+    if nav:
+        kb.row(*nav)
+    return kb
+
+def send_journal(chat_id, f):
+    rows, has_prev, has_next = journal_page(f)
+    bot.send_message(chat_id, journal_text(f, rows), reply_markup=journal_kb(f, rows, has_prev, has_next))
 
+@on_button("🧾 Журнал")
+def journal(message):
+    send_journal(message.chat.id, parse_filter_args(""))
+
+@bot.message_handler(commands=["journal"])
+def journal_cmd(message):
+    try:
+        f = parse_filter_args(message.text)
+    except ValueError:
+        bot.send_message(
+            message.chat.id,
+            "⚠️ Мысал: /journal 12 OUT 2026-09-01 2026-09-30\n"
+            "(тауар ID, түрі IN/OUT/WRITE_OFF және күн аралығы — бәрі міндетті емес)"
+        )
+        return
+    send_journal(message.chat.id, f)
+
+@on_callback("jr")
+def journal_page_cb(call):
+    _, direction, cursor, pid, code, d_from, d_to = call.data.split(":")
+    f = {
+        "pid": int(pid) if pid else None,
+        "mtype": JOURNAL_CODE_TYPES.get(code),
+        "from": datetime.strptime(d_from, "%Y%m%d").date() if d_from else None,
+        "to": datetime.strptime(d_to, "%Y%m%d").date() if d_to else None,
+    }
+    rows, has_prev, has_next = journal_page(f, int(cursor), "prev" if direction == "p" else "next")
+    bot.answer_callback_query(call.id)
     if not rows:
-        bot.send_message(message.chat.id, "✅ Аз қалған тауар жоқ (немесе min қойылмаған).")
         return
+    try:
+        bot.edit_message_text(
+            journal_text(f, rows), call.message.chat.id, call.message.message_id,
+            reply_markup=journal_kb(f, rows, has_prev, has_next)
+        )
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            raise
+
+# 13) ИМПОРТ 📥 (CSV / XLSX файлдан көп тауар)
+# Жолдар ағынмен оқылады, IMPORT_CHUNK жол сайын бір транзакция + executemany.
+# Бағандар: [id,] name, qty, exp_date, min_qty. id бар жол — сол тауарды жаңартады
+# (qty кіріс ретінде қосылады), id жоқ — атауы дәл сәйкес тірі тауарды, ондай жоқ
+# болса жаңа тауар қосылады. Әр qty > 0 үшін IN журналы.
+IMPORT_CHUNK = 1000
+IMPORT_COLUMNS = {
+    "id": "id",
+    "name": "name", "атауы": "name", "атау": "name", "название": "name",
+    "qty": "qty", "саны": "qty", "количество": "qty",
+    "exp_date": "exp_date", "мерзімі": "exp_date", "срок": "exp_date",
+    "min_qty": "min_qty", "min": "min_qty",
+}
+IMPORT_DEFAULT_ORDER = ("name", "qty", "exp_date", "min_qty")
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+def read_import_rows(filename: str, data: bytes):
+    if filename.lower().endswith(".xlsx"):
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        for row in wb.active.iter_rows(values_only=True):
+            yield ["" if v is None else str(v) for v in row]
+        wb.close()
+        return
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(text, dialect)
+
+# SQLite INTEGER 64 бит: одан үлкені executemany ішінде бүкіл бөлікті құлатады
+def import_int(value, what):
+    # XLSX сандары "12.0" болып келеді; "nan" -> ValueError
+    try:
+        n = int(value) if value.isdigit() else int(float(value))
+    except OverflowError:   # inf, -inf
+        raise ValueError(f"{what} қате")
+    if n < 0:
+        raise ValueError(f"{what} теріс")
+    if n > MAX_ID:
+        raise ValueError(f"{what} тым үлкен")
+    return n
+
+def parse_import_row(cells, columns):
+    rec = {col: (cells[i].strip() if i < len(cells) else "") for i, col in enumerate(columns) if col}
+    pid = int(rec["id"]) if rec.get("id") else None
+    if pid is not None and not 0 < pid <= MAX_ID:
+        raise ValueError("ID қате")
+    name = rec.get("name") or None
+    if pid is None and not name:
+        raise ValueError("атауы жоқ")
+    qty = import_int(rec["qty"], "саны") if rec.get("qty") else 0
+    exp = rec.get("exp_date") or None
+    if exp == "-":
+        exp = None
+    elif exp:
+        exp = date.fromisoformat(exp[:10]).toordinal()  # XLSX datetime -> "YYYY-MM-DD HH:MM:SS"
+    minq = import_int(rec["min_qty"], "min") if rec.get("min_qty") else None
+    return pid, name, qty, exp, minq
 
-    text = "⚠️ Аз қалған тауарлар:\n\n"
-    for pid, name, qty, minq in rows:
-        text += f"ID:{pid} | {name} — {qty} дана (min:{minq})\n"
-    bot.send_message(message.chat.id, text)
+def import_chunk(chunk, errors):
+    con = db()
+    now = now_ts()
+    with con:
+        # sqlite_sequence-тен id бөлу үшін жазу құлпы транзакция басында алынады
+        con.execute("BEGIN IMMEDIATE")
+        existing = products_by_ids([r[1] for r in chunk if r[1] is not None])
+        by_name = products_by_names([r[2] for r in chunk if r[1] is None])
+        existing.update((row[0], row) for row in by_name.values())
+        next_id = con.execute(
+            "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name='products'), 0), "
+            "COALESCE((SELECT MAX(id) FROM products), 0))"
+        ).fetchone()[0]
+        # бөлік ішінде бір тауар бірнеше рет келуі мүмкін: шек пен ескерту соңғы мәннен
+        cur = {}   # pid -> [name, qty, exp_day, min_qty]
+        new_ids = []
+        moves = []
+        updated = 0
+        for line, pid, name, qty, exp, minq in chunk:
+            if pid is None:
+                pid = by_name[name][0] if name in by_name else None
+            if pid is None:
+                next_id += 1
+                pid = next_id
+                by_name[name] = (pid,)
+                new_ids.append(pid)
+                cur[pid] = [name, qty, exp, minq or 0]
+            else:
+                if pid not in cur:
+                    prod = existing.get(pid)
+                    if prod is None:
+                        errors.writerow([line, "ID табылмады"])
+                        continue
+                    cur[pid] = list(prod[1:])
+                item = cur[pid]
+                if item[1] + qty > MAX_ID:
+                    errors.writerow([line, "саны тым үлкен"])
+                    continue
+                item[0] = name or item[0]
+                item[1] += qty
+                item[2] = exp or item[2]
+                item[3] = item[3] if minq is None else minq
+                updated += 1
+            if qty:
+                moves.append((pid, "IN", qty, now, "Импорт"))
+
+        new_set = set(new_ids)
+        con.executemany(
+            "UPDATE products SET name = ?, qty = ?, exp_day = ?, min_qty = ? WHERE id = ?",
+            [(*item, pid) for pid, item in cur.items() if pid not in new_set]
+        )
+        con.executemany(
+            "INSERT INTO products(id, name, qty, exp_day, min_qty) VALUES(?,?,?,?,?)",
+            [(pid, *cur[pid]) for pid in new_ids]
+        )
+        con.executemany(
+            "INSERT INTO movements(product_id, mtype, qty, created_at, comment) VALUES(?,?,?,?,?)", moves
+        )
 
-# 12) ЖУРНАЛ 🧾 (соңғы 30 операция)
-@bot.message_handler(func=lambda m: m.text == "🧾 Журнал")
-def journal(message):
+    for pid, (name, qty, exp, minq) in cur.items():
+        if exp:
+            exp_calendar.set(pid, exp)
+        if pid not in new_set:
+            prod = existing[pid]
+            stock_changed(pid, name, prod[2], qty, prod[4], minq)
+    return len(new_ids), updated
+
+@bot.message_handler(content_types=["document"])
+def import_document(message):
+    if not is_allowed(message.from_user.id):
+        return
+    doc = message.document
+    filename = doc.file_name or ""
+    if not filename.lower().endswith((".csv", ".txt", ".xlsx")):
+        bot.send_message(message.chat.id, "⚠️ Импорт үшін CSV немесе XLSX файл жіберіңіз.")
+        return
+    if filename.lower().endswith(".xlsx") and openpyxl is None:
+        bot.send_message(message.chat.id, "⚠️ XLSX оқу үшін openpyxl орнатылмаған. CSV ретінде сақтап жіберіңіз.")
+        return
+
+    clear_state(message.from_user.id)
+    data = bot.download_file(bot.get_file(doc.file_id).file_path)
+
+    error_file = io.StringIO()
+    errors = csv.writer(error_file)
+    errors.writerow(["line", "error"])
+    added = updated = 0
+    columns, chunk = None, []
+    for line, cells in enumerate(read_import_rows(filename, data), start=1):
+        if not any(c.strip() for c in cells):
+            continue
+        if columns is None:
+            columns = [IMPORT_COLUMNS.get(c.strip().lower()) for c in cells]
+            if "name" in columns or "id" in columns:
+                continue
+            columns = list(IMPORT_DEFAULT_ORDER)  # тақырып жоқ — бірінші жол да дерек
+        try:
+            chunk.append((line, *parse_import_row(cells, columns)))
+        except (ValueError, IndexError, OverflowError) as e:
+            errors.writerow([line, str(e) or "қате мән"])
+        if len(chunk) >= IMPORT_CHUNK:
+            a, u = import_chunk(chunk, errors)
+            added, updated, chunk = added + a, updated + u, []
+    if chunk:
+        a, u = import_chunk(chunk, errors)
+        added, updated = added + a, updated + u
+
+    error_lines = error_file.getvalue().count("\n") - 1
+    bot.send_message(
+        message.chat.id,
+        f"📥 Импорт аяқталды: {filename}\n"
+        f"• Жаңа тауар: {added}\n"
+        f"• Жаңартылды: {updated}\n"
+        f"• Қате жол: {error_lines}",
+        reply_markup=main_kb()
+    )
+    if error_lines:
+        report = io.BytesIO(error_file.getvalue().encode("utf-8-sig"))
+        report.name = "import_errors.csv"
+        bot.send_document(message.chat.id, report, caption="⚠️ Қате жолдар")
+
+# 14) ЭКСПОРТ 📤 (/export_products, /export_movements)
+# Курсордан EXPORT_CHUNK жолдан оқып, уақытша файлға CSV (қаласа gzip) жазамыз —
+# кесте жадқа толық жүктелмейді. Мысал:
+#   /export_movements 2026-01-01 2026-01-31 OUT gz
+EXPORT_CHUNK = 5000
+TG_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+def write_export(rows_iter, header, gz: bool):
+    raw = tempfile.TemporaryFile()
+    stream = gzip.GzipFile(fileobj=raw, mode="wb") if gz else raw
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(header)
+    rows = 0
+    rows_iter = iter(rows_iter)
+    while True:
+        batch = list(islice(rows_iter, EXPORT_CHUNK))
+        if not batch:
+            break
+        writer.writerows(batch)
+        rows += len(batch)
+    text.flush()
+    text.detach()
+    if gz:
+        stream.close()
+    raw.seek(0)
+    return raw, rows
+
+def send_export(chat_id, raw, rows, filename):
+    if os.fstat(raw.fileno()).st_size > TG_DOCUMENT_LIMIT:
+        raw.close()
+        bot.send_message(chat_id, "⚠️ Файл 50 MB-тан асты. Күн аралығын тарылтыңыз немесе gz қосыңыз.")
+        return
+    # файлды outbox жіберіп болған соң өзі жабады
+    bot.send_document(chat_id, raw, visible_file_name=filename, caption=f"📤 {rows} жол")
+
+@bot.message_handler(commands=["export_products"])
+def export_products(message):
+    if not is_allowed(message.from_user.id):
+        return
+    gz = "gz" in message.text.lower().split()[1:]
+    cur = db().execute("SELECT id, name, qty, exp_date, min_qty FROM products_v WHERE deleted_at IS NULL ORDER BY id")
+    raw, rows = write_export(cur, ["id", "name", "qty", "exp_date", "min_qty"], gz)
+    send_export(message.chat.id, raw, rows, "products.csv.gz" if gz else "products.csv")
+
+@bot.message_handler(commands=["export_movements"])
+def export_movements(message):
+    if not is_allowed(message.from_user.id):
+        return
+    try:
+        args = parse_filter_args(message.text)
+    except ValueError:
+        bot.send_message(
+            message.chat.id,
+            "⚠️ Мысал: /export_movements 2026-01-01 2026-01-31 OUT gz\n"
+            "(тауар ID, күндер, түрі IN/OUT/WRITE_OFF және gz — бәрі міндетті емес)"
+        )
+        return
+
+    where, params = ["m.id BETWEEN ? AND ?"], []
+    if args["from"]:
+        where.append("m.created_at >= ?")
+        params.append(day_start_ts(args["from"]))
+    if args["to"]:
+        where.append("m.created_at < ?")
+        params.append(day_start_ts(args["to"] + timedelta(days=1)))
+    if args["mtype"]:
+        where.append("m.mtype = ?")
+        params.append(args["mtype"])
+    if args["pid"]:
+        where.append("m.product_id = ?")
+        params.append(args["pid"])
     con = db()
-    cur = con.cursor()
-    cur.execute("""
-    SELECT m.id, p.name, m.mtype, m.qty, m.created_at, m.comment
-    FROM movements m
-    JOIN products p ON p.id = m.product_id
-    ORDER BY m.id DESC
-    LIMIT 30
-    """)
-    rows = cur.fetchall()
-    con.close()
+    # архивтегі ескі қозғалыстар алдымен, сосын негізгі база — id ретімен
+    cur = chain.from_iterable(con.execute(f"""
+    SELECT m.id, datetime(m.created_at, 'unixepoch', 'localtime'), m.mtype, m.product_id,
+           {PRODUCT_LABEL_SQL}, m.qty, m.comment
+    FROM {table} m
+    LEFT JOIN products p ON p.id = m.product_id
+    WHERE {" AND ".join(where)}
+    ORDER BY m.id
+    """, [a, b] + params) for table, a, b in movement_parts(con))
+    raw, rows = write_export(cur, ["id", "created_at", "mtype", "product_id", "product", "qty", "comment"], args["gz"])
+    send_export(message.chat.id, raw, rows, "movements.csv.gz" if args["gz"] else "movements.csv")
+
+# 15) ТОПТАМА 📋 (бір хабарламада көп жол: "12 x3", "45 x1 бұзылды")
+BATCH_TYPES = {
+    "OUT": ("➖ Сату", "Сату"),
+    "IN": ("➕ Кіріс", "Кіріс"),
+    "WRITE_OFF": ("🗑️ Списание", "Списание"),
+}
+# ID мен сан арасында бөлгіш міндетті (x/х/×/* немесе бос орын): әйтпесе "123"
+# ID:12 ×3 болып бөлініп кетеді, бір сан ғана — формат қатесі
+BATCH_LINE = re.compile(r"^\s*(\d+)\s*(?:[xх×*]\s*|\s+)(\d+)\s*(.*?)\s*$", re.IGNORECASE)
+
+@on_button("📋 Топтама")
+def batch_start(message):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(*(
+        types.InlineKeyboardButton(title, callback_data=f"batch:{mtype}")
+        for mtype, (title, _) in BATCH_TYPES.items()
+    ))
+    bot.send_message(message.chat.id, "Операция түрін таңдаңыз:", reply_markup=kb)
+
+@on_callback("batch")
+def batch_type_cb(call):
+    mtype = call.data.split(":")[1]
+    set_state(call.from_user.id, "BATCH_LINES", {"mtype": mtype})
+    bot.answer_callback_query(call.id)
+    bot.send_message(
+        call.message.chat.id,
+        f"{BATCH_TYPES[mtype][0]} — әр жолға бір тауар:\n"
+        "ID xСАН [түсініктеме]\n\n"
+        "Мысалы:\n12 x3\n45 x1"
+    )
 
-    if not rows:
-        bot.send_message(message.chat.id, "Журнал бос.")
+@on_step("BATCH_LINES")
+def batch_lines(message):
+    mtype = get_state(message.from_user.id)["data"]["mtype"]
+    default_comment = BATCH_TYPES[mtype][1]
+    items, errors = [], []
+    for n, line in enumerate(message.text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        m = BATCH_LINE.match(line)
+        if not m or int(m.group(2)) <= 0:
+            errors.append(f"{n}-жол: «{line.strip()}» — формат қате")
+            continue
+        items.append((int(m.group(1)), int(m.group(2)), m.group(3) or default_comment))
+    if not items and not errors:
+        errors.append("Бірде-бір жол жоқ")
+
+    clear_state(message.from_user.id)
+    if not errors:
+        result, errors = apply_batch(mtype, items)
+    if errors:
+        send_chunked(
+            message.chat.id, (e + "\n" for e in errors),
+            header="⚠️ Топтама өткізілмеді, ештеңе өзгерген жоқ:\n\n",
+            reply_markup=main_kb()
+        )
+        return
+
+    total = sum(qty for _, _, qty, _ in result)
+    send_chunked(
+        message.chat.id,
+        (f"ID:{pid} | {name} — {qty} дана (қалдық: {new_qty})\n" for pid, name, qty, new_qty in result),
+        header=f"🧾 {BATCH_TYPES[mtype][0]} — чек:\n\n",
+        footer=f"\nБарлығы: {len(result)} тауар, {total} дана",
+        reply_markup=main_kb()
+    )
+
+# 16) ҚОЙМАЛАР 🏬 (/tenants, /tenant_add, /tenant_user — әкімші; /tenant — ауысу)
+@bot.message_handler(commands=["tenants"])
+def tenants_cmd(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    counts = tenants.user_counts()
+    cur = current_tenant()
+    lines = [
+        f"{'✅' if t.id == cur.id else '•'} {t.code} — {t.name} ({counts.get(t.id, 0)} қолданушы)\n"
+        for t in tenants.all()
+    ]
+    send_chunked(message.chat.id, lines, header="🏬 Қоймалар:\n\n")
+
+@bot.message_handler(commands=["tenant_add"])
+def tenant_add_cmd(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    parts = message.text.split(maxsplit=2)
+    if len(parts) < 3 or not TENANT_CODE_RE.fullmatch(parts[1]):
+        bot.send_message(message.chat.id, "Формат: /tenant_add КОД Атауы\nКОД: a-z, 0-9, _ немесе - (32 таңбаға дейін)")
+        return
+    if tenants.by_code(parts[1]):
+        bot.send_message(message.chat.id, "⚠️ Бұл кодпен қойма бар.")
+        return
+    tenant = tenants.add(parts[1], parts[2].strip())
+    with tenant_scope(tenant):
+        db()   # файл мен схема бірден дайындалады
+    tenants.add_user(message.from_user.id, tenant)
+    bot.send_message(message.chat.id, f"✅ Қойма қосылды: {tenant.code} — {tenant.name}\nАуысу: /tenant {tenant.code}")
+
+@bot.message_handler(commands=["tenant_user"])
+def tenant_user_cmd(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    parts = message.text.split()
+    tenant = tenants.by_code(parts[2]) if len(parts) >= 3 else None
+    if len(parts) not in (3, 4) or not parts[1].isdigit() or tenant is None:
+        bot.send_message(message.chat.id, "Формат: /tenant_user USER_ID КОД [del]")
+        return
+    uid = int(parts[1])
+    if len(parts) == 4 and parts[3].lower() in ("del", "-"):
+        tenants.remove_user(uid, tenant)
+        bot.send_message(message.chat.id, f"✅ {uid} қолданушысы «{tenant.name}» қоймасынан шығарылды.")
+        return
+    tenants.add_user(uid, tenant)
+    bot.send_message(message.chat.id, f"✅ {uid} қолданушысы «{tenant.name}» қоймасына қосылды.")
+
+@bot.message_handler(commands=["tenant"])
+def tenant_cmd(message):
+    uid = message.from_user.id
+    parts = message.text.split()
+    available = tenants.all() if uid in ADMIN_IDS else tenants.memberships(uid)
+    if len(parts) < 2:
+        cur = current_tenant()
+        lines = [f"{'✅' if t.id == cur.id else '•'} {t.code} — {t.name}\n" for t in available]
+        send_chunked(message.chat.id, lines, header="🏬 Қоймалар (✅ — ағымдағы). Ауысу: /tenant КОД\n\n")
+        return
+    tenant = next((t for t in available if t.code == parts[1]), None)
+    if tenant is None:
+        bot.send_message(message.chat.id, "❌ Ондай қойма жоқ немесе қол жеткізу жоқ.")
+        return
+    if uid in ADMIN_IDS:
+        tenants.add_user(uid, tenant)
+    tenants.switch(uid, tenant)
+    # басталған ағындағы ID-лер бұрынғы қоймаға тиесілі; жаңа қоймада қалған ескі қадам да керек емес
+    clear_state(uid)
+    with tenant_scope(tenant):
+        clear_state(uid)
+    bot.send_message(message.chat.id, f"✅ Қойма ауыстырылды: {tenant.name}", reply_markup=main_kb())
+
+# 17) КҮНДЕГІ ҚАЛДЫҚ 📅 (/stock_at YYYY-MM-DD [ID]) және /compact (әкімші)
+@bot.message_handler(commands=["stock_at"])
+def stock_at_cmd(message):
+    if not is_allowed(message.from_user.id):
+        return
+    parts = message.text.split()
+    try:
+        day = date.fromisoformat(parts[1])
+        pid = int(parts[2]) if len(parts) > 2 else None
+    except (IndexError, ValueError):
+        bot.send_message(message.chat.id, "Формат: /stock_at YYYY-MM-DD [ID]\nМысалы: /stock_at 2026-01-31 12")
+        return
+
+    state = stock_at_date(day, pid)
+    if pid is not None:
+        prod = find_product_by_id(pid)
+        name = prod[1] if prod else f"(өшірілген ID:{pid})"
+        bot.send_message(message.chat.id, f"📅 {day} соңындағы қалдық:\nID:{pid} | {name} — {state.get(pid, 0)} дана")
         return
 
-    text = "🧾 Соңғы операциялар (30):\n\n"
-    for mid, pname, mtype, qty, created_at, comment in rows:
-        text += f"#{mid} | {mtype} | {pname} | {qty} дана | {created_at}"
-        if comment:
-            text += f" | {comment}"
-        text += "\n"
-    bot.send_message(message.chat.id, text)
+    names = dict(db().execute(f"SELECT p.id, {PRODUCT_LABEL_SQL} FROM products p"))
+    rows = (
+        (p, names.get(p, f"(өшірілген ID:{p})"), qty)
+        for p, qty in sorted(state.items()) if qty
+    )
+    raw, count = write_export(rows, ["id", "name", "qty"], False)
+    send_export(message.chat.id, raw, count, f"stock_{day}.csv")
+
+@bot.message_handler(commands=["compact"])
+def compact_cmd(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    snap, moved = compact()
+    snap_text = f"snapshot #{snap[0]} ({snap[1]} тауар)" if snap else "жаңа қозғалыс жоқ, snapshot керек емес"
+    bot.send_message(message.chat.id, f"🗜 {snap_text}\nАрхивке көшті: {moved} қозғалыс")
+
+# 18) БОЛЖАМ 📈 (сату жылдамдығы, таусылу мерзімі, тапсырыс ұсынысы)
+# OUT қозғалыстары analytics.SalesVelocity сақинасына бір рет жүктеледі,
+# кейін тек жаңа id-лер қосылады. Болжам бүкіл каталогқа бір векторлық есеп.
+FORECAST_WINDOW = int(os.getenv("FORECAST_WINDOW", "28"))   # орташа жылдамдық терезесі, күн
+LEAD_TIME_DAYS = int(os.getenv("LEAD_TIME_DAYS", "7"))      # тапсырыс келгенше
+COVER_DAYS = int(os.getenv("COVER_DAYS", "14"))             # тапсырыс қанша күнге жетуі керек
+SERVICE_Z = 1.65                                           # ~95% сервис деңгейі
+FORECAST_TOP = 30
+
+try:
+    import analytics
+except ImportError:
+    analytics = None
+
+class SalesForecast:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.model = analytics.SalesVelocity(FORECAST_WINDOW)
+        self.last_id = None
+
+    def refresh(self):
+        con = db()
+        with self._lock:
+            self.model.advance(date.today().toordinal())
+            if self.last_id is None:
+                start = date.today() - timedelta(days=FORECAST_WINDOW - 1)
+                self.last_id = movement_id_before(day_start_ts(start))
+            con.execute("BEGIN")   # жолдар мен соңғы id бір көріністен
+            try:
+                last = con.execute(
+                    "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='movements'), 0)"
+                ).fetchone()[0]
+                rows = con.execute(
+                    f"SELECT product_id, {local_day_sql('created_at')}, qty FROM movements "
+                    "WHERE mtype = 'OUT' AND product_id IS NOT NULL AND id > ? AND id <= ?", (self.last_id, last)
+                ).fetchall()
+            finally:
+                con.commit()
+            self.model.add(rows)
+            self.last_id = last
+
+    def run(self):
+        self.refresh()
+        products = db().execute("SELECT id, name, qty FROM products WHERE deleted_at IS NULL").fetchall()
+        pids = [p[0] for p in products]
+        qtys = [p[2] for p in products]
+        with self._lock:
+            velocity, days_left, reorder = self.model.forecast(pids, qtys, LEAD_TIME_DAYS, COVER_DAYS, SERVICE_Z)
+        risky = (days_left <= LEAD_TIME_DAYS + COVER_DAYS).nonzero()[0]
+        risky = risky[days_left[risky].argsort(kind="stable")]
+        return [
+            (products[i][0], products[i][1], products[i][2], float(velocity[i]), float(days_left[i]), int(reorder[i]))
+            for i in risky
+        ]
+
+sales_forecast = PerTenant(SalesForecast) if analytics else None
+
+@on_button("📈 Болжам")
+def forecast(message):
+    if sales_forecast is None:
+        bot.send_message(message.chat.id, "⚠️ Болжам үшін numpy орнатылмаған.")
+        return
+    rows = sales_forecast.run()
+    send_chunked(
+        message.chat.id,
+        (
+            f"ID:{pid} | {name} — {qty} дана, ~{v:.1f}/күн, {days:.0f} күнге жетеді → тапсырыс: {reorder}\n"
+            for pid, name, qty, v, days, reorder in rows[:FORECAST_TOP]
+        ),
+        header=f"📈 {LEAD_TIME_DAYS + COVER_DAYS} күн ішінде таусылатындар (соңғы {FORECAST_WINDOW} күн сатуы бойынша):\n\n",
+        footer=f"\nБарлығы: {len(rows)} тауар" if len(rows) > FORECAST_TOP else "",
+        empty_text="✅ Жақын арада таусылатын тауар жоқ.",
+        reply_markup=main_kb()
+    )
 
 # =====================================
 # ❌ Белгісіз мәтін / қолдау таппайды
 # =====================================
-@bot.message_handler(func=lambda message: True)
 def unsupported_message(message):
     bot.send_message(
         message.chat.id,
@@ -699,10 +3216,188 @@ def unsupported_message(message):
     )
 
 
+# =====================================
+# ROUTER: барлық мәтін мен callback осы екі handler арқылы өтеді
+# =====================================
+@bot.message_handler(func=lambda message: True)
+@self_timed
+def route_message(message):
+    t0 = time.perf_counter_ns()
+    handler = resolve_message(message)
+    ROUTER_STATS["updates"] += 1
+    ROUTER_STATS["dispatch_ns"] += time.perf_counter_ns() - t0
+    timed_handler(handler, message)
+
+@bot.callback_query_handler(func=lambda call: True)
+@self_timed
+def route_callback(call):
+    t0 = time.perf_counter_ns()
+    handler = CALLBACK_HANDLERS.get((call.data or "").partition(":")[0])
+    ROUTER_STATS["updates"] += 1
+    ROUTER_STATS["dispatch_ns"] += time.perf_counter_ns() - t0
+    if handler is None:
+        bot.answer_callback_query(call.id)
+        return
+    timed_handler(handler, call)
+
+
+# ================= SCHEDULER =================
+# Күнделікті дайджесттер: уақыты env арқылы ("HH:MM", үтірмен бірнеше), бос болса — өшірулі
+EXP_DIGEST_AT = os.getenv("EXP_DIGEST_AT", "09:00")
+LOW_DIGEST_AT = os.getenv("LOW_DIGEST_AT", "09:00")
+COMPACT_AT = os.getenv("COMPACT_AT", "03:00")   # snapshot + архив
+
+def parse_times(spec: str):
+    times = []
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            hh, mm = part.split(":")
+            times.append((int(hh), int(mm)))
+    return sorted(times)
+
+class Job:
+    def __init__(self, name, fn, at=None, every=None):
+        self.name = name
+        self.fn = fn
+        self.times = parse_times(at) if at else []
+        self.every = every
+        self.next_run = self._next(datetime.now())
+
+    def _next(self, now):
+        if self.every:
+            return now + timedelta(seconds=self.every)
+        for hh, mm in self.times:
+            t = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+            if t > now:
+                return t
+        hh, mm = self.times[0]
+        return (now + timedelta(days=1)).replace(hour=hh, minute=mm, second=0, microsecond=0)
+
+# Бір фондық поток: келесі тапсырма уақытына дейін ұйықтайды, update өңдеуді бөгемейді.
+# gunicorn бірнеше worker іске қосқанда дайджест қайталанбауы үшін
+# тапсырмаларды тек lock файлын ұстаған процесс орындайды.
+SCHEDULER_LOCK = os.getenv("SCHEDULER_LOCK", DB_PATH + ".scheduler.lock")
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    def _acquire_leader(self):
+        if fcntl is None:
+            return True
+        f = open(SCHEDULER_LOCK, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    def add(self, name, fn, at=None, every=None):
+        if at or every:
+            self.jobs.append(Job(name, fn, at=at, every=every))
+
+    def start(self):
+        if self.jobs and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # басқа процесс жетекші болса — ол құлағанда орнын басу үшін күте тұрамыз
+        while not self._acquire_leader():
+            if self._stop.wait(60):
+                return
+        while not self._stop.is_set():
+            now = datetime.now()
+            for job in self.jobs:
+                if job.next_run <= now:
+                    try:
+                        job.fn()
+                    except Exception as e:
+                        print(f"job {job.name} failed: {e}")
+                    job.next_run = job._next(datetime.now())
+            wake = min(job.next_run for job in self.jobs)
+            self._stop.wait(max(1.0, (wake - datetime.now()).total_seconds()))
+
+# Аз қалғандар жиыны: бірінші рет индекс бойынша толық алынады, кейін тек
+# соңғы іске қосылудан бері өзгерген тауарлар (updated_at >= watermark) қайта бағаланады.
+class LowStockDigest:
+    def __init__(self):
+        self.items = {}
+        self.watermark = None
+
+    def refresh(self):
+        con = db()
+        since, self.watermark = self.watermark, int(time.time())
+        if since is None:
+            self.items = {row[0]: row for row in con.execute(LOW_STOCK_SQL)}
+            return
+        for pid, name, qty, minq in con.execute(
+            "SELECT id, name, qty, min_qty FROM products WHERE updated_at >= ? AND deleted_at IS NULL", (since,)
+        ):
+            if is_low(qty, minq):
+                self.items[pid] = (pid, name, qty, minq)
+            else:
+                self.items.pop(pid, None)
+        alive = products_by_ids(list(self.items))
+        for pid in [pid for pid in self.items if pid not in alive]:
+            del self.items[pid]
+
+    def rows(self):
+        return sorted(self.items.values(), key=lambda r: r[2])
+
+low_digest = PerTenant(LowStockDigest)
+
+# Дайджесттер әр қойма бойынша жеке, сол қойманың қолданушыларына
+def for_each_tenant(fn):
+    def run():
+        for tenant in tenants.all():
+            with tenant_scope(tenant):
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"{fn.__name__} for tenant {tenant.code} failed: {e}")
+    return run
+
+def send_expiry_digest():
+    exp_calendar.sync()
+    near = exp_calendar.within(EXP_HORIZON_DAYS)
+    if not near:
+        return
+    for uid in tenant_recipients():
+        send_chunked(uid, expiry_lines(near), header=f"{tenant_tag()}⏰ Таңғы дайджест — мерзімі жақын ({EXP_HORIZON_DAYS} күн):\n\n")
+
+def send_low_stock_digest():
+    low_digest.refresh()
+    rows = low_digest.rows()
+    if not rows:
+        return
+    for uid in tenant_recipients():
+        send_chunked(
+            uid,
+            (f"ID:{pid} | {name} — {qty} дана (min:{minq})\n" for pid, name, qty, minq in rows),
+            header=f"{tenant_tag()}⚠️ Күнделікті дайджест — аз қалған тауарлар:\n\n"
+        )
+
+scheduler = Scheduler()
+scheduler.add("expiry_digest", for_each_tenant(send_expiry_digest), at=EXP_DIGEST_AT)
+scheduler.add("low_stock_digest", for_each_tenant(send_low_stock_digest), at=LOW_DIGEST_AT)
+scheduler.add("state_purge", for_each_tenant(purge_states), every=STATE_TTL)
+scheduler.add("compaction", for_each_tenant(compact), at=COMPACT_AT)
+
+
 # ================= WEB (Flask) =================
 
 import threading
-from flask import Flask
+from flask import Flask, request, abort
 
 app = Flask(__name__)
 
@@ -710,6 +3405,32 @@ app = Flask(__name__)
 def home():
     return "Bot is running", 200
 
+@app.get("/metrics")
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# Telegram-ға бірден 200 қайтарамыз, өңдеу update_executor-да жүреді.
+# Кезек толса 503 — Telegram жаңартуды кейін қайта жібереді.
+@app.post("/webhook/<secret>")
+def webhook(secret):
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        abort(403)
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(header, WEBHOOK_SECRET):
+        abort(403)
+    if update_executor.pending >= WEBHOOK_QUEUE:
+        return "busy", 503
+    bot.process_new_updates([types.Update.de_json(request.get_data(as_text=True))])
+    return "", 200
+
+
+def setup_webhook():
+    url = f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}"
+    # әр gunicorn worker-і шақырады — URL өзгермесе Telegram-ды қайта мазаламаймыз
+    if bot.get_webhook_info().url != url:
+        bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+
 
 def run_web():
     port = int(os.environ.get("PORT", 10000))
@@ -723,12 +3444,23 @@ def start_bot():
     bot.infinity_polling(skip_pending=True)
 
 
+if WEBHOOK_URL:
+    # gunicorn main:app кезінде __main__ орындалмайды — импорт кезінде дайындаймыз
+    init_tenant_dbs()
+    setup_webhook()
+    scheduler.start()
+
+
 if __name__ == "__main__":
-    init_db()
+    if WEBHOOK_URL:
+        run_web()
+    else:
+        init_tenant_dbs()
+        scheduler.start()
 
-    # Telegram ботты бөлек потокта іске қосамыз
-    bot_thread = threading.Thread(target=start_bot)
-    bot_thread.start()
+        # Telegram ботты бөлек потокта іске қосамыз
+        bot_thread = threading.Thread(target=start_bot)
+        bot_thread.start()
 
-    # Flask серверді негізгі потокта іске қосамыз
-    run_web()
\ No newline at end of file
+        # Flask серверді негізгі потокта іске қосамыз
+        run_web()